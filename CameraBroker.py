@@ -0,0 +1,228 @@
+import time
+import queue
+import threading
+from typing import Optional
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from PyQt5 import QtGui
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QLabel
+from PyQt5.QtCore import Qt
+
+from FramePool import FramePool
+from FramePool import PooledFrame
+
+# Seconds to wait after a failed read, and the number of failed reads in a row after which the camera is reopened
+READ_RETRY_DELAY = 0.1
+REOPEN_AFTER = 30
+
+
+class Subscription:
+    """
+    Queue of the frames a CameraBroker hands to one consumer
+    """
+
+    def __init__(self, broker: "CameraBroker", every: int, size: Optional[Tuple[int, int]], max_queue: int):
+        """
+        :param broker: The broker delivering the frames
+        :param every: Only every n-th captured frame is delivered
+        :param size: The (width, height) frames are downscaled to, full resolution pooled frames are delivered if None
+        :param max_queue: The number of frames queued before new frames are dropped
+        """
+        self.broker = broker
+        self.every = every
+        self.size = size
+        self.frames = queue.Queue(max_queue)
+        self.count = 0
+        self.dropped = 0
+
+    def deliver(self, t: float, frame: PooledFrame) -> None:
+        """
+        Called on the capture thread of the broker
+        """
+        self.count += 1
+        if self.count % self.every != 0:
+            return
+
+        if self.size is not None:
+            small = cv2.resize(frame.array, self.size, interpolation=cv2.INTER_AREA)
+            frame = PooledFrame(None, small)
+        else:
+            frame.retain()
+
+        try:
+            self.frames.put_nowait((t, frame))
+        except queue.Full:
+            frame.release()
+            self.dropped += 1
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Tuple[float, PooledFrame]]:
+        """
+        :return: the time the frame was read and the frame, which must be released by the caller.  None on timeout
+        """
+        try:
+            return self.frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        self.broker.unsubscribe(self)
+        while True:
+            try:
+                self.frames.get_nowait()[1].release()
+            except queue.Empty:
+                return
+
+
+class CameraBroker:
+    """
+    Owns the camera and fans its frames out to every subscriber, so that the device is opened once and stays warm
+    between sessions
+    """
+
+    def __init__(self, device: int = 0, pool_size: int = 16):
+        self.device = device
+        self.pool_size = pool_size
+        self.pool = None
+        self.resolution = None
+
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._running = False
+        self._suspended = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._running = False
+        self._resumed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def suspend(self) -> None:
+        """
+        Releases the camera so another process can open it, until resume() is called
+        """
+        if self._thread is None:
+            return
+        self._ready.clear()
+        self._resumed.clear()
+        self._suspended.wait()
+
+    def resume(self) -> None:
+        self._suspended.clear()
+        self._resumed.set()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        :return: whether the camera delivered its first frame within the timeout
+        """
+        return self._ready.wait(timeout)
+
+    def subscribe(self, every: int = 1, size: Optional[Tuple[int, int]] = None, max_queue: int = 8) -> Subscription:
+        sub = Subscription(self, every, size, max_queue)
+        with self._lock:
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def run(self) -> None:
+        while self._running:
+            cap = cv2.VideoCapture(self.device)
+            failures = 0
+            while self._running and self._resumed.is_set():
+                if failures >= REOPEN_AFTER:
+                    # A camera which was unplugged or reset keeps failing until it is opened again
+                    print("Camera %s failed %d reads in a row, reopening it" % (self.device, failures))
+                    cap.release()
+                    cap = cv2.VideoCapture(self.device)
+                    failures = 0
+
+                if self.pool is None:
+                    ret, frame = cap.read()
+                    if not ret:
+                        failures += 1
+                        time.sleep(READ_RETRY_DELAY)
+                        continue
+                    self.pool = FramePool(frame.shape, frame.dtype, self.pool_size)
+                    self.resolution = (frame.shape[1], frame.shape[0])
+
+                buf = self.pool.acquire()
+                try:
+                    ret, frame = cap.read(image=buf.array)
+                    if not ret:
+                        failures += 1
+                        time.sleep(READ_RETRY_DELAY)
+                        continue
+                    failures = 0
+                    if frame is not buf.array:
+                        # The camera changed resolution, frames are read into new buffers from now on
+                        self.pool = FramePool(frame.shape, frame.dtype, self.pool_size)
+                        self.resolution = (frame.shape[1], frame.shape[0])
+                        buf.release()
+                        buf = PooledFrame(None, frame)
+                    t = time.time()
+                    self._ready.set()
+
+                    with self._lock:
+                        subscribers = list(self._subscribers)
+                    for sub in subscribers:
+                        sub.deliver(t, buf)
+                finally:
+                    buf.release()
+
+            cap.release()
+            self._suspended.set()
+            self._resumed.wait()
+
+
+class CameraPreview(QLabel):
+    """
+    Shows a low rate, downscaled live view of the camera
+    """
+
+    def __init__(self, broker: CameraBroker, every: int = 3, size: Tuple[int, int] = (320, 240), *args, **kwargs):
+        super(CameraPreview, self).__init__(*args, **kwargs)
+        self.setAlignment(Qt.AlignCenter)
+        self.setText("Waiting for camera...")
+
+        self.subscription = broker.subscribe(every, size, max_queue=2)
+
+        self.timer = QtCore.QTimer(self)
+        # noinspection PyUnresolvedReferences
+        self.timer.timeout.connect(self.on_timer)
+        self.timer.start(30)
+
+    def on_timer(self) -> None:
+        e = None
+        while True:
+            n = self.subscription.get(0)
+            if n is None:
+                break
+            e = n
+        if e is None:
+            return
+
+        frame = np.ascontiguousarray(e[1].array)
+        fmt = QtGui.QImage.Format_Grayscale8 if frame.ndim == 2 else QtGui.QImage.Format_BGR888
+        img = QtGui.QImage(frame.data, frame.shape[1], frame.shape[0], frame.strides[0], fmt)
+        self.setPixmap(QtGui.QPixmap.fromImage(img).scaled(self.size(), Qt.KeepAspectRatio))
+
+    def close_subscription(self) -> None:
+        self.timer.stop()
+        self.subscription.close()
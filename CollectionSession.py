@@ -0,0 +1,235 @@
+import time
+import queue
+import platform
+import threading
+from datetime import datetime
+from typing import Tuple
+
+import numpy as np
+
+from CameraBroker import CameraBroker
+from FramePool import PooledFrame
+from Serialization import serializer_from_config
+from Serialization import default_station_id
+
+
+class CollectionSession:
+    """
+    Owns everything a collection run needs, from before the first prompt until the last sample is written
+
+    prepare() waits for the camera and sets up the serializer, its connections and the frame buffers, so the first
+    prompts are not slowed down by one time setup.  Frames are handed to a writer thread through a bounded queue, and
+    stop() drains the queue and closes the serializer within one timeout before the session metadata is written
+    """
+
+    def __init__(
+            self,
+            config: dict,
+            broker: CameraBroker,
+            latency_offset: float = 0.0,
+            cycle_length: float = 1.0,
+            max_pending: int = 64
+    ):
+        """
+        :param config: The output configuration, see TargetOptions.get_session_config()
+        :param broker: The broker delivering the frames of the camera
+        :param latency_offset: The display to capture latency in seconds
+        :param cycle_length: Seconds between prompts, recorded in the metadata
+        :param max_pending: Number of frames waiting to be written before new frames are dropped
+        """
+        self.config = config
+        self.broker = broker
+        self.latency_offset = latency_offset
+        self.cycle_length = cycle_length
+        self.max_pending = max_pending
+
+        self.session_id = datetime.today().strftime("%Y%m%d-%H%M%S")
+        self.serializer = None
+        self.start_time = None
+        self.end_time = None
+
+        self.submitted = 0
+        self.handled = 0
+        self.failed = 0
+        self.dropped = 0
+        self.abandoned = 0
+
+        self.target_status = None
+
+        self._queue = queue.Queue(max_pending)
+        self._thread = None
+
+    def prepare(self, timeout: float = 5.0) -> None:
+        """
+        Sets up every resource of the session, called before the first prompt is shown
+
+        :param timeout: Seconds to wait for the first frame of the camera
+        """
+        start = time.time()
+        if not self.broker.wait_ready(timeout):
+            raise ValueError("The camera did not deliver a frame within %.1fs" % timeout)
+
+        self.serializer = serializer_from_config(self.config)
+        w, h = self.broker.resolution
+        try:
+            self.serializer.warm_up(np.zeros((h, w, 3), np.uint8))
+        except Exception as e:
+            self.serializer.close()
+            self.serializer = None
+            raise ValueError("Failed to prepare the output: %s" % e)
+        self.serializer.start_session(self.session_id)
+
+        # The queued frames keep their pooled buffers, which must not run out while the writer catches up
+        pool = self.broker.pool
+        if pool is not None:
+            pool.reserve(self.broker.pool_size + self.max_pending)
+
+        # A writer stuck in a write is left behind once stop() times out
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        print("Session %s prepared in %.2fs" % (self.session_id, time.time() - start))
+
+    def start(self) -> None:
+        """
+        Called as the first prompt is shown
+        """
+        self.start_time = datetime.today()
+
+    def submit(self, point: Tuple[float, float], t: float, frame: PooledFrame) -> None:
+        """
+        Queues a frame to be written without blocking the capture loop, frames are dropped when the writer falls
+        behind by more than max_pending frames
+
+        :param point: The prompt on screen when the frame was exposed
+        :param t: The time the frame was read
+        :param frame: The frame, which is retained until it is written
+        """
+        self.submitted += 1
+        extra = {
+            "timestamp": t - self.latency_offset,
+            "latency_offset": self.latency_offset,
+            "session": self.session_id
+        }
+        frame.retain()
+        try:
+            self._queue.put_nowait((point, t, frame, extra))
+        except queue.Full:
+            frame.release()
+            self.dropped += 1
+
+    def run(self) -> None:
+        while True:
+            e = self._queue.get()
+            if e is None:
+                return
+            point, t, frame, extra = e
+            try:
+                # The files are named from the capture time, since frames are written in bursts after a backlog
+                self.serializer.handle_data(point, frame.array, extra, t)
+                self.handled += 1
+            except Exception as ex:
+                print("Failed to write sample: %s" % ex)
+                self.failed += 1
+            finally:
+                frame.release()
+
+    def stop(self, timeout: float = 10.0) -> dict:
+        """
+        Waits for the pending frames to be written, then closes the serializer and writes the session metadata.
+        Frames still pending after the timeout are discarded and counted as abandoned
+
+        :param timeout: Seconds to wait for the pending frames, including the writes still queued inside of the
+            serializer
+        :return: the session metadata
+        """
+        self.end_time = datetime.today()
+        start = time.time()
+        if self._thread is not None:
+            last_report = start
+            while self._thread.is_alive():
+                try:
+                    self._queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+                if time.time() - start > timeout:
+                    break
+                if time.time() - last_report > 1:
+                    print("Writing %d pending samples..." % self._queue.qsize())
+                    last_report = time.time()
+
+            while self._thread.is_alive() and time.time() - start < timeout:
+                self._thread.join(min(1.0, max(timeout - (time.time() - start), 0.0)))
+                if self._thread.is_alive():
+                    print("Writing %d pending samples..." % self._queue.qsize())
+
+            if self._thread.is_alive():
+                # The writer stops at the sentinel once the discarded frames are gone
+                while True:
+                    try:
+                        e = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if e is not None:
+                        e[2].release()
+                        self.abandoned += 1
+                self._queue.put(None)
+                self._thread.join(max(timeout - (time.time() - start), 0.0))
+                print("Abandoned %d samples which were not written within %.1fs" % (self.abandoned, timeout))
+
+        serializer = self.serializer
+        self.serializer = None
+        if serializer is not None:
+            if self._thread is not None and self._thread.is_alive():
+                # Closing the serializer under a write in progress is not safe, the writer stops on its own once the
+                # write returns.  A disk journal left open is recovered when the next session starts
+                print("The output is still writing a sample and was left open")
+            else:
+                try:
+                    serializer.close(max(timeout - (time.time() - start), 0.0))
+                except Exception as e:
+                    print("Failed to close the output: %s" % e)
+            if serializer.status is not None:
+                self.target_status = serializer.status
+            else:
+                gate = serializer.quality_gate
+                self.target_status = {self.config["type"]: {
+                    "ok": self.handled - (gate.dropped if gate is not None else 0),
+                    "failed": self.failed,
+                    "filtered": gate.dropped if gate is not None else 0
+                }}
+        self._thread = None
+
+        metadata = self.metadata()
+        if serializer is not None:
+            try:
+                serializer.write_session(self.session_id, metadata)
+            except Exception as e:
+                print("Failed to write the session metadata: %s" % e)
+        print("Session %s: %d handled, %d dropped, %d failed, %d abandoned, outputs %s" % (
+            self.session_id, self.handled, self.dropped, self.failed, self.abandoned, self.target_status))
+        return metadata
+
+    def metadata(self) -> dict:
+        return {
+            "session": self.session_id,
+            "station": self.config.get("station_id") or default_station_id(),
+            "platform": platform.platform(),
+            "start": self.start_time.isoformat() if self.start_time is not None else None,
+            "end": self.end_time.isoformat() if self.end_time is not None else None,
+            "output": self.config["type"],
+            "camera": {
+                "device": self.broker.device,
+                "resolution": self.broker.resolution
+            },
+            "latency_offset": self.latency_offset,
+            "cycle_length": self.cycle_length,
+            "frames": {
+                "submitted": self.submitted,
+                "handled": self.handled,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "abandoned": self.abandoned
+            },
+            "targets": self.target_status
+        }
@@ -0,0 +1,221 @@
+"""
+Packs a tree written by DiskSerializer into large shard files
+
+usage: python Compactor.py <base_dir> <out_dir> [--workers N] [--shard-size N] [--quality Q]
+
+The list of samples and their assignment to shards is saved to <out_dir>/manifest.json on the first run.
+Rerunning the same command after an interruption only builds the shards that have no index yet
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from Serialization import pair_samples
+from Shards import ShardWriter
+from Shards import shard_name
+
+
+def load_sample(img_path: str, lbl_path: str, quality: Optional[int]) -> Tuple[Optional[bytes], dict, str]:
+    """
+    Reads and validates a single sample
+
+    :param img_path: The path of the jpeg image
+    :param lbl_path: The path of the json label
+    :param quality: The jpeg quality to re-encode the image with, the original bytes are kept if None
+    :return: the encoded image (None if invalid), the label and the reason the sample was rejected
+    """
+    try:
+        with open(lbl_path) as f:
+            label = json.load(f)
+        if not (0 <= float(label["x"]) <= 1 and 0 <= float(label["y"]) <= 1):
+            return None, label, "label out of range"
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return None, {}, "invalid label: %s" % e
+
+    try:
+        with open(img_path, "rb") as f:
+            img = f.read()
+    except OSError as e:
+        return None, label, "unreadable image: %s" % e
+
+    frame = cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        return None, label, "corrupt image"
+
+    if quality is not None:
+        ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            return None, label, "failed to re-encode image"
+        img = buf.tobytes()
+
+    return img, label, ""
+
+
+def build_shard(
+        out_dir: str,
+        name: str,
+        samples: List[Tuple[str, str, str]],
+        quality: Optional[int]
+) -> Tuple[str, int, int, int]:
+    """
+    Builds a single shard, runs inside of a worker process
+
+    :return: name of the shard, number of samples packed, number of samples rejected, bytes written
+    """
+    # The source images are about the size of the packed ones, so their total size is used to preallocate the shard
+    expected = 0
+    for _, img_path, _ in samples:
+        try:
+            expected += os.path.getsize(img_path)
+        except OSError:
+            pass
+
+    writer = ShardWriter(out_dir, name, expected)
+    for key, img_path, lbl_path in samples:
+        img, label, reason = load_sample(img_path, lbl_path, quality)
+        if img is None:
+            writer.reject(key, reason)
+        else:
+            writer.add(key, img, label)
+    writer.close()
+    return name, len(writer.samples), len(writer.rejected), writer.offset
+
+
+def load_manifest(
+        base_dir: str,
+        out_dir: str,
+        img_dir: str,
+        lbl_dir: str,
+        shard_size: int,
+        executor: Optional[Executor] = None
+) -> dict:
+    """
+    Loads the manifest of a previous run, or scans base_dir and creates a new one
+
+    :param executor: The pool the directories of base_dir are walked on
+    """
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["base_dir"] != os.path.abspath(base_dir):
+            raise ValueError("%s was created from %s" % (out_dir, manifest["base_dir"]))
+        # The completed shards were cut with these settings, resuming with others would mix two assignments
+        for name, value in (("img_dir", img_dir), ("lbl_dir", lbl_dir), ("shard_size", shard_size)):
+            if manifest.get(name) != value:
+                raise ValueError("%s was created with %s %s" % (out_dir, name, manifest.get(name)))
+        return manifest
+
+    samples = list(pair_samples(base_dir, img_dir, lbl_dir, executor))
+    manifest = {
+        "base_dir": os.path.abspath(base_dir),
+        "img_dir": img_dir,
+        "lbl_dir": lbl_dir,
+        "shard_size": shard_size,
+        "shards": [
+            {
+                "name": shard_name(i // shard_size),
+                "samples": samples[i:i + shard_size]
+            }
+            for i in range(0, len(samples), shard_size)
+        ]
+    }
+
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+
+def write_index(out_dir: str, manifest: dict) -> None:
+    """
+    Writes index.json which maps every packed key to the index of its shard
+    """
+    keys = {}
+    for e in manifest["shards"]:
+        with open(os.path.join(out_dir, e["name"] + ".idx.json")) as f:
+            for s in json.load(f)["samples"]:
+                keys[s["key"]] = e["name"] + ".idx.json"
+
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump({"keys": keys}, f)
+
+
+def compact(
+        base_dir: str,
+        out_dir: str,
+        img_dir: str = "images",
+        lbl_dir: str = "labels",
+        workers: Optional[int] = None,
+        shard_size: int = 4096,
+        quality: Optional[int] = None
+) -> None:
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        manifest = load_manifest(base_dir, out_dir, img_dir, lbl_dir, shard_size, pool)
+        todo = [
+            e for e in manifest["shards"]
+            if not os.path.isfile(os.path.join(out_dir, e["name"] + ".idx.json"))
+        ]
+        print("%d shards, %d already complete" % (len(manifest["shards"]), len(manifest["shards"]) - len(todo)))
+
+        start = time.time()
+        n_samples = 0
+        n_rejected = 0
+        n_bytes = 0
+        futures = [pool.submit(build_shard, out_dir, e["name"], e["samples"], quality) for e in todo]
+        for i, fut in enumerate(as_completed(futures)):
+            name, packed, rejected, size = fut.result()
+            n_samples += packed + rejected
+            n_rejected += rejected
+            n_bytes += size
+
+            elapsed = max(time.time() - start, 1e-6)
+            print("[%d/%d] %s: %d samples, %d rejected | %.1f samples/s, %.1f MB/s" % (
+                i + 1, len(todo), name, packed, rejected, n_samples / elapsed, n_bytes / elapsed / 1e6
+            ))
+
+    write_index(out_dir, manifest)
+    print("Done: %d samples (%d rejected), %.1f MB in %.1fs" % (
+        n_samples, n_rejected, n_bytes / 1e6, time.time() - start
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Packs a DiskSerializer output tree into shard files")
+    parser.add_argument("base_dir", help="The base directory of the DiskSerializer output")
+    parser.add_argument("out_dir", help="The directory to write the shards to")
+    parser.add_argument("--img-dir", default="images", help="The image directory relative to base_dir")
+    parser.add_argument("--lbl-dir", default="labels", help="The label directory relative to base_dir")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--shard-size", type=int, default=4096, help="Number of samples per shard")
+    parser.add_argument("--quality", type=int, default=None, help="Re-encode images with this jpeg quality")
+    args = parser.parse_args(argv)
+
+    compact(
+        args.base_dir,
+        args.out_dir,
+        args.img_dir,
+        args.lbl_dir,
+        args.workers,
+        args.shard_size,
+        args.quality
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+import os
+import json
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from abc import ABC, abstractmethod
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from Serialization import pair_samples
+from Shards import ShardReader
+from Shards import read_shard_index
+
+
+def jpeg_size(img: bytes) -> Tuple[int, int]:
+    """
+    Reads the (width, height) of a jpeg from its SOF marker without decoding it
+
+    :param img: The encoded jpeg
+    """
+    i = 2
+    n = len(img)
+    while i + 9 < n:
+        if img[i] != 0xFF:
+            i += 1
+            continue
+        marker = img[i + 1]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h = (img[i + 5] << 8) | img[i + 6]
+            w = (img[i + 7] << 8) | img[i + 8]
+            return w, h
+        i += 2 + ((img[i + 2] << 8) | img[i + 3])
+    raise ValueError("Corrupt image")
+
+
+class Dataset(ABC):
+    """
+    Abstract base class for all stored datasets which can be read back
+    """
+
+    @abstractmethod
+    def keys(self) -> List[str]:
+        """
+        :return: the keys of all the samples in the dataset, sorted
+        """
+
+    @abstractmethod
+    def read(self, key: str) -> Tuple[bytes, dict]:
+        """
+        Reads a single sample without decoding it
+
+        :param key: The key of the sample, ex. 20201015/123055-123
+        :return: the encoded image and the label of the sample
+        """
+
+
+class DiskDataset(Dataset):
+    """
+    Dataset stored in the layout written by DiskSerializer
+    """
+
+    def __init__(self, base_dir: str, img_dir: str = "images", lbl_dir: str = "labels"):
+        self.samples = {k: (img, lbl) for k, img, lbl in pair_samples(base_dir, img_dir, lbl_dir)}
+
+    def keys(self) -> List[str]:
+        return sorted(self.samples)
+
+    def read(self, key: str) -> Tuple[bytes, dict]:
+        img_path, lbl_path = self.samples[key]
+        with open(img_path, "rb") as f:
+            img = f.read()
+        with open(lbl_path) as f:
+            label = json.load(f)
+        return img, label
+
+
+class ShardDataset(Dataset):
+    """
+    Dataset stored as shards written by the compactor
+    """
+
+    def __init__(self, shard_dir: str):
+        self.index = read_shard_index(shard_dir)
+        self._local = threading.local()
+
+    def keys(self) -> List[str]:
+        return sorted(self.index)
+
+    def read(self, key: str) -> Tuple[bytes, dict]:
+        # Every thread keeps its own file handles since ShardReader seeks before reading
+        if not hasattr(self._local, "readers"):
+            self._local.readers = {}
+        index_path = self.index[key]
+        if index_path not in self._local.readers:
+            self._local.readers[index_path] = ShardReader(index_path)
+        return self._local.readers[index_path].read(key)
+
+
+def open_dataset(path: str, img_dir: str = "images", lbl_dir: str = "labels") -> Dataset:
+    """
+    Opens either a directory of shards or a DiskSerializer output tree
+
+    :param path: The shard directory or the base directory of the DiskSerializer
+    """
+    if os.path.isfile(os.path.join(path, "index.json")) or \
+            any(e.endswith(".idx.json") for e in os.listdir(path)):
+        return ShardDataset(path)
+    return DiskDataset(path, img_dir, lbl_dir)
+
+
+class DatasetReader:
+    """
+    Decodes the samples of a dataset on a thread pool and prefetches them ahead of the consumer
+
+    cv2 releases the GIL while decoding, so decoding scales with the number of threads
+    """
+
+    def __init__(
+            self,
+            dataset: Dataset,
+            size: Optional[Tuple[int, int]] = None,
+            crop: Optional[Tuple[int, int, int, int]] = None,
+            grayscale: bool = False,
+            threads: int = 4,
+            prefetch: int = 64,
+            shuffle: bool = False,
+            seed: int = 0,
+            worker_id: int = 0,
+            num_workers: int = 1,
+            on_error: str = "skip"
+    ):
+        """
+        :param dataset: The dataset to read
+        :param size: The (width, height) to resize every frame to
+        :param crop: The (x, y, width, height) region of the original frame to keep, applied before resizing
+        :param grayscale: Whether to decode the frames as grayscale
+        :param threads: Number of decoding threads
+        :param prefetch: Maximum number of samples decoded ahead of the consumer
+        :param shuffle: Whether to shuffle the order of the samples each epoch
+        :param seed: The seed of the shuffle, the order is identical across processes with the same seed
+        :param worker_id: The index of this worker process
+        :param num_workers: The total number of worker processes sharing the dataset
+        :param on_error: What iterating does with a sample which cannot be read or decoded
+            skip   the sample is left out and counted in self.errors
+            raise  the error ends the iteration
+        """
+        if not 0 <= worker_id < num_workers:
+            raise ValueError("worker_id must be in [0, num_workers)")
+        if on_error not in ("skip", "raise"):
+            raise ValueError("Unknown on_error: %s" % on_error)
+
+        self.dataset = dataset
+        self.size = size
+        self.crop = crop
+        self.grayscale = grayscale
+        self.threads = threads
+        self.prefetch = prefetch
+        self.shuffle = shuffle
+        self.seed = seed
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.on_error = on_error
+        self.epoch = 0
+        self.errors = 0
+        self._errors_lock = threading.Lock()
+
+        self._all_keys = dataset.keys()
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Selects the epoch used to seed the shuffle, all workers must use the same epoch
+        """
+        self.epoch = epoch
+
+    def keys(self) -> List[str]:
+        """
+        :return: the keys read by this worker in the current epoch
+        """
+        keys = list(self._all_keys)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(keys)
+        return keys[self.worker_id::self.num_workers]
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __getitem__(self, key: str) -> Tuple[np.ndarray, dict]:
+        img, label = self.dataset.read(key)
+        return self.decode(img), label
+
+    def load(self, key: str) -> Optional[Tuple[np.ndarray, dict]]:
+        """
+        Reads and decodes a sample on a decoding thread
+
+        :return: the frame and label, None if the sample is invalid and errors are skipped
+        """
+        try:
+            return self[key]
+        except (OSError, ValueError, KeyError) as e:
+            if self.on_error == "raise":
+                raise
+            with self._errors_lock:
+                self.errors += 1
+            print("Skipping %s: %s" % (key, e))
+            return None
+
+    def __iter__(self) -> Iterator[Tuple[str, np.ndarray, dict]]:
+        keys = iter(self.keys())
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            pending = deque()
+            for k in keys:
+                pending.append((k, pool.submit(self.load, k)))
+                if len(pending) >= self.prefetch:
+                    break
+
+            while pending:
+                k, fut = pending.popleft()
+                for n in keys:
+                    pending.append((n, pool.submit(self.load, n)))
+                    break
+                e = fut.result()
+                if e is None:
+                    continue
+                yield k, e[0], e[1]
+
+    def decode(self, img: bytes) -> np.ndarray:
+        """
+        Decodes a jpeg and applies the crop and resize
+
+        When the frame is downscaled by at least 2x, the jpeg decoder is asked for a reduced resolution image
+        directly, which skips most of the decoding work
+        """
+        buf = np.frombuffer(img, np.uint8)
+        scale = 1
+        if self.size is not None:
+            if self.crop is not None:
+                w, h = self.crop[2], self.crop[3]
+            else:
+                w, h = jpeg_size(img)
+            while scale < 8 and w // (scale * 2) >= self.size[0] and h // (scale * 2) >= self.size[1]:
+                scale *= 2
+
+        flags = {
+            (1, False): cv2.IMREAD_COLOR,
+            (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+            (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+            (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+            (1, True): cv2.IMREAD_GRAYSCALE,
+            (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+            (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+            (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8
+        }[(scale, self.grayscale)]
+        frame = cv2.imdecode(buf, flags)
+        if frame is None:
+            raise ValueError("Corrupt image")
+
+        if self.crop is not None:
+            x, y, w, h = (e // scale for e in self.crop)
+            frame = frame[y:y + h, x:x + w]
+        if self.size is not None and (frame.shape[1], frame.shape[0]) != tuple(self.size):
+            frame = cv2.resize(frame, tuple(self.size), interpolation=cv2.INTER_AREA)
+        return frame
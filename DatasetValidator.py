@@ -0,0 +1,506 @@
+"""
+Checks a dataset for corrupt images, orphaned images or labels and labels out of range, and reports statistics of
+the samples it holds
+
+usage: python DatasetValidator.py <source> [--workers N] [--decode] [--report PATH] [--s3]
+
+<source> is the base directory of a Disk configuration, a directory of compacted shards, or with --s3 the name of an
+S3 configuration.  Images are checked from their jpeg markers without decoding the pixels unless --decode is given.
+The result of every file is cached along with its size and modification time (its ETag for S3 objects), so reruns
+only check the files that changed since
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from DatasetReader import jpeg_size
+from Serialization import cache_dir
+from Serialization import split_layout_key
+from Shards import list_shards
+
+
+def check_image(img: bytes, decode: bool = False) -> dict:
+    """
+    Checks an encoded image from its start, end and frame markers
+
+    :param img: The encoded jpeg
+    :param decode: Whether to also decode the pixels, which catches corrupt entropy coded data at a much higher cost
+    :return: the size, resolution and content hash of the image, with an "error" entry if it is invalid
+    """
+    result = {
+        "bytes": len(img),
+        "hash": hashlib.md5(img).hexdigest()
+    }
+    if not img.startswith(b"\xff\xd8"):
+        result["error"] = "missing start of image marker"
+        return result
+    # Some encoders pad the file after the end of image marker
+    if not img.rstrip(b"\x00").endswith(b"\xff\xd9"):
+        result["error"] = "truncated image"
+        return result
+    try:
+        result["w"], result["h"] = jpeg_size(img)
+    except (ValueError, IndexError):
+        result["error"] = "missing frame header"
+        return result
+
+    if decode and cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_UNCHANGED) is None:
+        result["error"] = "corrupt image"
+    return result
+
+
+def check_label(key: str, label) -> dict:
+    """
+    :param key: The key of the sample, its directory is used as the session when the label does not name one
+    :param label: The parsed label
+    :return: the location and session of the label, with an "error" entry if it is invalid
+    """
+    try:
+        x = float(label["x"])
+        y = float(label["y"])
+    except (KeyError, TypeError, ValueError) as e:
+        return {"error": "invalid label: %s" % e}
+
+    result = {
+        "x": x,
+        "y": y,
+        "session": label.get("session") or key.rsplit('/', 1)[0]
+    }
+    if not (0 <= x <= 1 and 0 <= y <= 1):
+        result["error"] = "label out of range"
+    return result
+
+
+def read_label(data: bytes, key: str) -> dict:
+    try:
+        label = json.loads(data)
+    except ValueError as e:
+        return {"error": "invalid label: %s" % e}
+    return check_label(key, label)
+
+
+def check_disk_files(source: str, files: List[Tuple[str, str, str]], decode: bool) -> List[Tuple[str, dict]]:
+    """
+    Checks a chunk of the files of a DiskSerializer tree, runs inside of a worker process
+
+    :param files: list of (path relative to source, "img" or "lbl", sample key)
+    :return: list of (path relative to source, result)
+    """
+    results = []
+    for rel_path, kind, key in files:
+        try:
+            with open(os.path.join(source, rel_path), "rb") as f:
+                data = f.read()
+        except OSError as e:
+            results.append((rel_path, {"error": "unreadable file: %s" % e}))
+            continue
+        results.append((rel_path, check_image(data, decode) if kind == "img" else read_label(data, key)))
+    return results
+
+
+def check_shard(index_path: str, decode: bool) -> List[dict]:
+    """
+    Checks every sample of a shard by reading its data file sequentially, runs inside of a worker process
+
+    :return: one result per sample, with its key
+    """
+    with open(index_path) as f:
+        index = json.load(f)
+
+    results = []
+    with open(os.path.join(os.path.dirname(index_path), index["data"]), "rb") as f:
+        for e in sorted(index["samples"], key=lambda s: s["offset"]):
+            f.seek(e["offset"])
+            img = f.read(e["size"])
+            result = check_image(img, decode)
+            if len(img) != e["size"]:
+                result["error"] = "sample extends past the end of the shard"
+            result["label"] = check_label(e["key"], e["label"])
+            result["key"] = e["key"]
+            results.append(result)
+    return results
+
+
+def check_s3_objects(
+        config: dict,
+        endpoint_url: Optional[str],
+        objects: List[Tuple[str, str, str]],
+        decode: bool
+) -> List[Tuple[str, dict]]:
+    """
+    Checks a chunk of the objects of a bucket, runs inside of a worker process
+
+    :param objects: list of (object key, "img" or "lbl", sample key)
+    :return: list of (object key, result)
+    """
+    from S3Sync import create_client
+    client = create_client(config, endpoint_url)
+
+    results = []
+    for obj_key, kind, key in objects:
+        try:
+            data = client.get_object(Bucket=config["bucket"], Key=obj_key)["Body"].read()
+        except Exception as e:
+            results.append((obj_key, {"error": "unreadable object: %s" % e}))
+            continue
+        results.append((obj_key, check_image(data, decode) if kind == "img" else read_label(data, key)))
+    return results
+
+
+def load_cache(path: str, decode: bool) -> Dict[str, list]:
+    """
+    :return: map from each file to [stamp, result], empty if the cache was made with a different decode setting
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        cache = json.load(f)
+    if cache.get("decode") != decode:
+        return {}
+    return cache["files"]
+
+
+def save_cache(path: str, decode: bool, files: Dict[str, list]) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"decode": decode, "files": files}, f)
+    os.replace(tmp_path, path)
+
+
+def list_disk_files(source: str, img_dir: str, lbl_dir: str) -> List[Tuple[str, str, str, list]]:
+    """
+    Lists every image and label of a DiskSerializer tree, including the ones missing their counterpart
+
+    :return: list of (path relative to source, "img" or "lbl", sample key, [size, modification time])
+    """
+    files = []
+    for kind, directory, exts in (("img", img_dir, (".jpg", ".jpeg")), ("lbl", lbl_dir, (".json",))):
+        root_dir = os.path.join(source, directory)
+        for root, _, names in os.walk(root_dir):
+            for e in names:
+                name, ext = os.path.splitext(e)
+                if ext.lower() not in exts or e.startswith('.'):
+                    continue
+                path = os.path.join(root, e)
+                st = os.stat(path)
+                key = os.path.relpath(os.path.join(root, name), root_dir).replace("\\", '/')
+                files.append((os.path.relpath(path, source), kind, key, [st.st_size, st.st_mtime_ns]))
+    return files
+
+
+def list_s3_objects(client, config: dict) -> List[Tuple[str, str, str, list]]:
+    """
+    Lists every image and label of the bucket of an S3 configuration
+
+    :return: list of (object key, "img" or "lbl", sample key, [ETag])
+    """
+    layout = config.get("key_layout", "date")
+    objects = []
+    for kind, directory in (("img", config["img_dir"]), ("lbl", config["lbl_dir"])):
+        directory = directory.replace("\\", '/')
+        for page in client.get_paginator("list_objects_v2").paginate(Bucket=config["bucket"], Prefix=directory + '/'):
+            for obj in page.get("Contents", []):
+                name = split_layout_key(layout, directory, obj["Key"])
+                objects.append((obj["Key"], kind, os.path.splitext(name)[0], [obj["ETag"]]))
+    return objects
+
+
+def run_checks(
+        files: List[Tuple[str, str, str, list]],
+        cache: Dict[str, list],
+        submit,
+        chunk_size: int
+) -> List[Tuple[str, str, dict]]:
+    """
+    Checks the files which are not in the cache on the worker pool, updating the cache in place
+
+    :param files: list of (file id, "img" or "lbl", sample key, stamp)
+    :param submit: Called with a chunk of (file id, kind, sample key) and returns a future of [(file id, result)]
+    :return: list of (kind, sample key, result) of every file
+    """
+    # Files which no longer exist are forgotten, so the cache does not grow forever
+    for file_id in set(cache) - {e[0] for e in files}:
+        del cache[file_id]
+    todo = [e for e in files if e[0] not in cache or cache[e[0]][0] != e[3]]
+    print("%d files, %d unchanged, %d to check" % (len(files), len(files) - len(todo), len(todo)))
+
+    stamps = {e[0]: e[3] for e in todo}
+    futures = [
+        submit([e[:3] for e in todo[i:i + chunk_size]])
+        for i in range(0, len(todo), chunk_size)
+    ]
+    start = time.time()
+    checked = 0
+    for i, fut in enumerate(as_completed(futures)):
+        for file_id, result in fut.result():
+            cache[file_id] = [stamps[file_id], result]
+        checked += chunk_size
+        if (i + 1) % 20 == 0:
+            print("[%d/%d] %.1f files/s" % (min(checked, len(todo)), len(todo), checked / max(time.time() - start, 1e-6)))
+
+    return [(kind, key, cache[file_id][1]) for file_id, kind, key, _ in files]
+
+
+def shard_results(
+        shard_dir: str,
+        cache: Dict[str, list],
+        pool: ProcessPoolExecutor,
+        decode: bool
+) -> List[Tuple[str, str, dict]]:
+    """
+    Checks the shards which are not in the cache on the worker pool, updating the cache in place
+
+    :return: list of (kind, sample key, result) of every sample
+    """
+    stamps = {}
+    for index_path in list_shards(shard_dir):
+        data_path = os.path.join(shard_dir, os.path.basename(index_path)[:-len(".idx.json")] + ".bin")
+        st = os.stat(index_path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        if os.path.isfile(data_path):
+            st = os.stat(data_path)
+            stamp += [st.st_size, st.st_mtime_ns]
+        stamps[os.path.basename(index_path)] = stamp
+
+    for name in set(cache) - set(stamps):
+        del cache[name]
+    todo = [name for name, stamp in stamps.items() if name not in cache or cache[name][0] != stamp]
+    print("%d shards, %d unchanged, %d to check" % (len(stamps), len(stamps) - len(todo), len(todo)))
+
+    futures = {pool.submit(check_shard, os.path.join(shard_dir, name), decode): name for name in todo}
+    for i, fut in enumerate(as_completed(futures)):
+        name = futures[fut]
+        try:
+            samples = fut.result()
+        except (OSError, ValueError, KeyError) as e:
+            print("Failed to check %s: %s" % (name, e))
+            samples = [{"key": name, "error": "unreadable shard: %s" % e, "label": {"error": "unreadable shard"}}]
+        cache[name] = [stamps[name], samples]
+        print("[%d/%d] %s: %d samples" % (i + 1, len(todo), name, len(samples)))
+
+    results = []
+    for name in stamps:
+        for e in cache[name][1]:
+            results.append(("img", e["key"], e))
+            results.append(("lbl", e["key"], e["label"]))
+    return results
+
+
+def build_report(results: List[Tuple[str, str, dict]], grid: int = 10, max_examples: int = 20) -> dict:
+    """
+    Aggregates the results of every file into the report of the dataset
+
+    :param results: list of (kind, sample key, result)
+    :param grid: The number of cells per side of the coverage histogram
+    :param max_examples: The number of example keys listed for every kind of problem
+    """
+    images = {}
+    labels = {}
+    for kind, key, result in results:
+        (images if kind == "img" else labels).setdefault(key, []).append(result)
+
+    errors = {}
+    for kind, key, result in results:
+        if "error" in result:
+            errors.setdefault(result["error"].split(':')[0], []).append(key)
+
+    valid_images = [r for rs in images.values() for r in rs if "error" not in r]
+    valid_labels = [r for rs in labels.values() for r in rs if "error" not in r]
+
+    sizes = np.array([r["bytes"] for r in valid_images], np.int64)
+    resolutions = np.array([(r["w"], r["h"]) for r in valid_images], np.int64).reshape(-1, 2)
+    hashes = np.array([r["hash"] for r in valid_images])
+    xs = np.array([r["x"] for r in valid_labels], np.float64)
+    ys = np.array([r["y"] for r in valid_labels], np.float64)
+    sessions = np.array([r["session"] for r in valid_labels])
+
+    coverage = np.histogram2d(ys, xs, bins=grid, range=[[0, 1], [0, 1]])[0].astype(np.int64)
+    session_names, session_counts = np.unique(sessions, return_counts=True)
+    res_values, res_counts = np.unique(resolutions, axis=0, return_counts=True)
+    hash_values, hash_counts = np.unique(hashes, return_counts=True)
+    duplicate_hashes = set(hash_values[hash_counts > 1])
+
+    def examples(keys):
+        return {"count": len(keys), "examples": sorted(keys)[:max_examples]}
+
+    report = {
+        "samples": len(set(images) & set(labels)),
+        "images": sum(len(rs) for rs in images.values()),
+        "labels": sum(len(rs) for rs in labels.values()),
+        "errors": {reason: examples(keys) for reason, keys in sorted(errors.items())},
+        "orphan_images": examples(list(set(images) - set(labels))),
+        "orphan_labels": examples(list(set(labels) - set(images))),
+        "duplicate_keys": examples(
+            [k for k, rs in images.items() if len(rs) > 1] + [k for k, rs in labels.items() if len(rs) > 1]
+        ),
+        "duplicate_images": examples(
+            [k for k, rs in images.items() for r in rs if r.get("hash") in duplicate_hashes and "error" not in r]
+        ),
+        "coverage": {
+            "grid": coverage.tolist(),
+            "empty_cells": int((coverage == 0).sum()),
+            "min": int(coverage.min()),
+            "max": int(coverage.max())
+        },
+        "sessions": {str(k): int(v) for k, v in zip(session_names, session_counts)},
+        "resolutions": {"%dx%d" % (w, h): int(n) for (w, h), n in zip(res_values, res_counts)}
+    }
+    if len(sizes):
+        p = np.percentile(sizes, [0, 10, 50, 90, 100])
+        report["image_bytes"] = {
+            "mean": float(sizes.mean()),
+            "min": int(p[0]),
+            "p10": float(p[1]),
+            "median": float(p[2]),
+            "p90": float(p[3]),
+            "max": int(p[4]),
+            "total": int(sizes.sum())
+        }
+    return report
+
+
+def has_problems(report: dict) -> bool:
+    return bool(
+        report["errors"] or
+        report["orphan_images"]["count"] or
+        report["orphan_labels"]["count"] or
+        report["duplicate_keys"]["count"]
+    )
+
+
+def print_report(report: dict) -> None:
+    print("%d samples (%d images, %d labels)" % (report["samples"], report["images"], report["labels"]))
+    for reason, e in report["errors"].items():
+        print("  %s: %d" % (reason, e["count"]))
+    for name in ("orphan_images", "orphan_labels", "duplicate_keys", "duplicate_images"):
+        if report[name]["count"]:
+            print("  %s: %d, ex. %s" % (name.replace('_', ' '), report[name]["count"], report[name]["examples"][0]))
+    if "image_bytes" in report:
+        b = report["image_bytes"]
+        print("Image size: median %.1f KB, p10 %.1f KB, p90 %.1f KB, %.1f MB total" % (
+            b["median"] / 1e3, b["p10"] / 1e3, b["p90"] / 1e3, b["total"] / 1e6))
+    print("Resolutions: %s" % ", ".join("%s (%d)" % e for e in report["resolutions"].items()))
+    counts = list(report["sessions"].values())
+    if counts:
+        print("Sessions: %d, %d to %d frames each" % (len(counts), min(counts), max(counts)))
+    c = report["coverage"]
+    print("Coverage: %d of %d cells empty, %d to %d samples per cell" % (
+        c["empty_cells"], len(c["grid"]) ** 2, c["min"], c["max"]))
+
+
+def validate(
+        source: str,
+        img_dir: str = "images",
+        lbl_dir: str = "labels",
+        workers: Optional[int] = None,
+        decode: bool = False,
+        s3: bool = False,
+        config_dir: Optional[str] = None,
+        endpoint_url: Optional[str] = None,
+        cache_path: Optional[str] = None,
+        grid: int = 10,
+        chunk_size: int = 256
+) -> dict:
+    """
+    :param source: The base directory of a Disk configuration, a directory of shards, or the name of an S3
+        configuration if s3 is True
+    :param img_dir: The local image directory relative to source
+    :param lbl_dir: The local label directory relative to source
+    :param workers: Number of worker processes
+    :param decode: Whether to fully decode every image
+    :param s3: Whether source names an S3 configuration
+    :param config_dir: The directory of the saved configurations
+    :param endpoint_url: The url of an S3 compatible endpoint
+    :param cache_path: The file the results are cached in, defaults to a file inside of source (the cache directory
+        of the application for S3)
+    :param grid: The number of cells per side of the coverage histogram
+    :param chunk_size: Number of files checked per task
+    :return: the report, see build_report()
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if s3:
+            from S3Sync import load_config
+            from S3Sync import create_client
+            from S3Sync import config_dir as default_config_dir
+            config = load_config(source, config_dir or default_config_dir)
+            if cache_path is None:
+                cache_path = os.path.join(cache_dir, "validate-%s.json" % config["bucket"])
+            cache = load_cache(cache_path, decode)
+            files = list_s3_objects(create_client(config, endpoint_url), config)
+            results = run_checks(
+                files,
+                cache,
+                lambda chunk: pool.submit(check_s3_objects, config, endpoint_url, chunk, decode),
+                chunk_size
+            )
+        else:
+            if cache_path is None:
+                cache_path = os.path.join(source, ".validate-cache.json")
+            cache = load_cache(cache_path, decode)
+            if list_shards(source):
+                results = shard_results(source, cache, pool, decode)
+            else:
+                results = run_checks(
+                    list_disk_files(source, img_dir, lbl_dir),
+                    cache,
+                    lambda chunk: pool.submit(check_disk_files, source, chunk, decode),
+                    chunk_size
+                )
+
+    if not os.path.isdir(os.path.dirname(os.path.abspath(cache_path))):
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)))
+    save_cache(cache_path, decode, cache)
+    return build_report(results, grid)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Checks a dataset and reports statistics of its samples")
+    parser.add_argument("source", help="The base directory of a Disk configuration, a directory of shards, or the "
+                                       "name of an S3 configuration with --s3")
+    parser.add_argument("--img-dir", default="images", help="The local image directory relative to source")
+    parser.add_argument("--lbl-dir", default="labels", help="The local label directory relative to source")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--decode", action="store_true", help="Fully decode every image")
+    parser.add_argument("--s3", action="store_true", help="Source is the name of an S3 configuration")
+    parser.add_argument("--config-dir", default=None, help="The directory of the saved configurations")
+    parser.add_argument("--endpoint-url", default=None, help="The url of an S3 compatible endpoint")
+    parser.add_argument("--cache", default=None, help="The file the results are cached in")
+    parser.add_argument("--grid", type=int, default=10, help="Number of cells per side of the coverage histogram")
+    parser.add_argument("--report", default=None, help="Write the full report to this json file")
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    report = validate(
+        args.source,
+        args.img_dir,
+        args.lbl_dir,
+        args.workers,
+        args.decode,
+        args.s3,
+        args.config_dir,
+        args.endpoint_url,
+        args.cache,
+        args.grid
+    )
+    print_report(report)
+    print("Done in %.1fs" % (time.time() - start))
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
+    return 1 if has_problems(report) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,110 @@
+import threading
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+
+class PooledFrame:
+    """
+    A frame buffer borrowed from a FramePool
+
+    Every stage which keeps the frame after handing it on must call retain(), and release() once it is done.
+    The buffer returns to the pool when the last reference is released.  Frames without a pool are not counted
+    """
+
+    def __init__(self, pool: Optional["FramePool"], array: np.ndarray):
+        self.pool = pool
+        self.array = array
+        # Whether the buffer belongs to the pool, temporary buffers are discarded once released
+        self.owned = False
+        self._refs = 0
+
+    def retain(self) -> "PooledFrame":
+        if self.pool is None:
+            return self
+        with self.pool.lock:
+            self._refs += 1
+        return self
+
+    def release(self) -> None:
+        if self.pool is None:
+            return
+        with self.pool.lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+            if self._refs < 0:
+                raise RuntimeError("PooledFrame released more times than it was retained")
+            self.pool.put_back(self)
+
+
+class FramePool:
+    """
+    Fixed set of preallocated frame buffers which the capture loop reads into
+    """
+
+    def __init__(self, shape: Tuple[int, ...], dtype=np.uint8, size: int = 8):
+        """
+        :param shape: The shape of a single frame, ex. (720, 1280, 3)
+        :param dtype: The dtype of a single frame
+        :param size: The number of buffers to preallocate
+        """
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.size = size
+        self.lock = threading.Lock()
+
+        self._free = [self._allocate() for _ in range(size)]
+
+        self.acquired = 0
+        self.exhausted = 0
+
+    def acquire(self) -> PooledFrame:
+        """
+        Borrows a buffer holding one reference.  If every buffer is in use, a temporary buffer is allocated
+        and counted in self.exhausted; it is discarded instead of being returned to the pool
+        """
+        with self.lock:
+            self.acquired += 1
+            if self._free:
+                frame = self._free.pop()
+            else:
+                self.exhausted += 1
+                frame = PooledFrame(self, np.empty(self.shape, self.dtype))
+            frame._refs = 1
+            return frame
+
+    def reserve(self, size: int) -> None:
+        """
+        Grows the pool to at least size buffers, and writes every free buffer once so that their pages are mapped
+        before the capture loop needs them
+        """
+        with self.lock:
+            while self.size < size:
+                self._free.append(self._allocate())
+                self.size += 1
+            for frame in self._free:
+                frame.array.fill(0)
+
+    def put_back(self, frame: PooledFrame) -> None:
+        """
+        Called by PooledFrame.release() with the pool lock held
+        """
+        if frame.owned:
+            self._free.append(frame)
+
+    def _allocate(self) -> PooledFrame:
+        frame = PooledFrame(self, np.empty(self.shape, self.dtype))
+        frame.owned = True
+        return frame
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": self.size,
+                "free": len(self._free),
+                "in_use": self.size - len(self._free),
+                "acquired": self.acquired,
+                "exhausted": self.exhausted
+            }
@@ -0,0 +1,135 @@
+from typing import List
+from typing import Optional
+
+import cv2
+import numpy as np
+
+QUALITY_ACTIONS = ["off", "tag", "drop"]
+
+
+def default_quality_config() -> dict:
+    return {
+        "action": "off",
+        "min_sharpness": 30.0,
+        "max_clipped": 0.3,
+        "require_face": True
+    }
+
+
+class QualityGate:
+    """
+    Computes cheap quality metrics on a downsampled grayscale copy of each frame
+
+    Metrics:
+        sharpness  variance of the laplacian, low values mean motion blur or an out of focus camera
+        clipped    fraction of pixels which are nearly black or nearly white
+        face       whether a frontal face was detected
+    """
+
+    def __init__(
+            self,
+            action: str = "tag",
+            min_sharpness: float = 30.0,
+            max_clipped: float = 0.3,
+            require_face: bool = True,
+            width: int = 160
+    ):
+        """
+        :param action: "tag" to add the metrics to the label, "drop" to also discard frames failing a check
+        :param min_sharpness: Minimum variance of the laplacian
+        :param max_clipped: Maximum fraction of clipped pixels
+        :param require_face: Whether frames without a detected face fail
+        :param width: Width of the downsampled copy the metrics are computed on
+        """
+        if action not in ("tag", "drop"):
+            raise ValueError("Unknown quality action: %s" % action)
+        self.action = action
+        self.min_sharpness = min_sharpness
+        self.max_clipped = max_clipped
+        self.require_face = require_face
+        self.width = width
+
+        self.face_detector = None
+        if require_face:
+            self.face_detector = cv2.CascadeClassifier(
+                cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+
+        self.passed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["QualityGate"]:
+        """
+        :param config: The "quality" entry of an output configuration
+        :return: the gate, or None if the checks are turned off
+        """
+        if config["action"] == "off":
+            return None
+        return cls(
+            config["action"],
+            config["min_sharpness"],
+            config["max_clipped"],
+            config["require_face"]
+        )
+
+    def measure(self, frame: np.ndarray) -> dict:
+        h, w = frame.shape[:2]
+        size = (self.width, max(1, h * self.width // w))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        sharpness = float(cv2.Laplacian(small, cv2.CV_32F).var())
+        hist = np.bincount(small.ravel(), minlength=256)
+        clipped = float(hist[:6].sum() + hist[250:].sum()) / small.size
+
+        metrics = {
+            "sharpness": sharpness,
+            "clipped": clipped
+        }
+        if self.face_detector is not None:
+            faces = self.face_detector.detectMultiScale(small, 1.2, 3, minSize=(size[0] // 8, size[0] // 8))
+            metrics["face"] = len(faces) > 0
+        return metrics
+
+    def judge(self, metrics: dict) -> List[str]:
+        """
+        :return: the names of the checks the metrics failed
+        """
+        failures = []
+        if metrics["sharpness"] < self.min_sharpness:
+            failures.append("blur")
+        if metrics["clipped"] > self.max_clipped:
+            failures.append("exposure")
+        if self.require_face and not metrics.get("face", False):
+            failures.append("face")
+        return failures
+
+    def apply(self, frame: np.ndarray, label: dict) -> bool:
+        """
+        Measures the frame and tags the label with the metrics
+
+        :param frame: The captured frame
+        :param label: The label of the frame, the metrics are added under "quality"
+        :return: False if the frame is to be dropped
+        """
+        return self.apply_metrics(self.measure(frame), label)
+
+    def apply_metrics(self, metrics: dict, label: dict) -> bool:
+        """
+        Same as apply() with metrics which were already measured, ex. by another gate for the same frame
+        """
+        failures = self.judge(metrics)
+        if not failures:
+            self.passed += 1
+        else:
+            self.failed += 1
+            if self.action == "drop":
+                self.dropped += 1
+                return False
+
+        metrics = dict(metrics)
+        metrics["failed"] = failures
+        label["quality"] = metrics
+        return True
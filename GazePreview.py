@@ -0,0 +1,240 @@
+import queue
+import threading
+from typing import Optional
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from PyQt5 import QtGui
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QWidget
+from PyQt5.QtCore import Qt
+
+from FramePool import PooledFrame
+
+
+class OnlineRidge:
+    """
+    Ridge regression fitted incrementally from its sufficient statistics X^T X and X^T Y
+    """
+
+    def __init__(self, n_features: int, n_outputs: int = 2, alpha: float = 1.0):
+        self.alpha = alpha
+        self.xtx = np.zeros((n_features + 1, n_features + 1))
+        self.xty = np.zeros((n_features + 1, n_outputs))
+        self.n = 0
+        self._weights = None
+
+    def update(self, x: np.ndarray, y: np.ndarray) -> None:
+        """
+        :param x: (n, n_features) batch of features
+        :param y: (n, n_outputs) batch of targets
+        """
+        x = np.hstack([x, np.ones((len(x), 1))])
+        self.xtx += x.T @ x
+        self.xty += x.T @ y
+        self.n += len(x)
+        self._weights = None
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        if self._weights is None:
+            reg = self.alpha * np.eye(len(self.xtx))
+            reg[-1, -1] = 0  # the bias is not regularized
+            self._weights = np.linalg.solve(self.xtx + reg, self.xty)
+        return np.hstack([x, np.ones((len(x), 1))]) @ self._weights
+
+
+class EyeFeatures:
+    """
+    Extracts a small normalized crop of the eye region of the detected face
+    """
+
+    def __init__(self, crop_size: Tuple[int, int] = (24, 8), width: int = 160):
+        self.crop_size = crop_size
+        self.width = width
+        self.n_features = crop_size[0] * crop_size[1]
+        self.face_detector = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+
+    def __call__(self, frame: np.ndarray) -> Optional[np.ndarray]:
+        """
+        :return: the feature vector, or None if no face was found
+        """
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, (self.width, max(1, h * self.width // w)), interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+        faces = self.face_detector.detectMultiScale(small, 1.2, 3, minSize=(self.width // 8, self.width // 8))
+        if len(faces) == 0:
+            return None
+        x, y, fw, fh = max(faces, key=lambda f: f[2] * f[3])
+
+        # The eyes sit roughly between 20% and 55% of the face height
+        band = small[y + fh // 5:y + fh * 11 // 20, x:x + fw]
+        crop = cv2.resize(band, self.crop_size, interpolation=cv2.INTER_AREA).astype(np.float64).ravel()
+        crop -= crop.mean()
+        crop /= crop.std() + 1e-6
+        return crop
+
+
+class GazePreview:
+    """
+    Fits a gaze model in the background while data is collected, to estimate whether a session has enough data
+
+    Every fifth prompt is held out from the fit and used to measure the error of the model.  The error is in
+    screen units, ie. 0.1 is a tenth of the screen
+    """
+
+    def __init__(self, grid: int = 10, holdout_every: int = 5, alpha: float = 10.0, queue_size: int = 4):
+        self.grid = grid
+        self.holdout_every = holdout_every
+        self.alpha = alpha
+
+        self.features = EyeFeatures()
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        # Orders submit() against stop(), so no frame is queued once the queue has been drained
+        self._submit_lock = threading.Lock()
+        self._thread = None
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Discards the model, called when a new session starts
+        """
+        with self._lock:
+            self.model = OnlineRidge(self.features.n_features, alpha=self.alpha)
+            self.coverage = np.zeros((self.grid, self.grid), np.int64)
+            self.holdout_x = []
+            self.holdout_y = []
+            self.error = None
+            self.no_face = 0
+            self.dropped = 0
+            self._last_point = None
+            self._prompt_num = 0
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._submit_lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+        # Frames left behind if the model thread ended on an error
+        while True:
+            try:
+                e = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if e is not None:
+                e[1].release()
+
+    def submit(self, point: Tuple[float, float], frame: PooledFrame) -> None:
+        """
+        Queues a frame for the model without blocking the capture loop, frames are dropped when the model falls behind.
+        Frames are ignored once the model is stopped
+        """
+        with self._submit_lock:
+            if self._thread is None:
+                return
+            frame.retain()
+            try:
+                self._queue.put_nowait((point, frame))
+            except queue.Full:
+                frame.release()
+                self.dropped += 1
+
+    def run(self) -> None:
+        while True:
+            e = self._queue.get()
+            if e is None:
+                return
+            point, frame = e
+            try:
+                x = self.features(frame.array)
+            finally:
+                frame.release()
+            self.add_sample(point, x)
+
+    def add_sample(self, point: Tuple[float, float], x: Optional[np.ndarray]) -> None:
+        with self._lock:
+            if point != self._last_point:
+                self._last_point = point
+                self._prompt_num += 1
+            if x is None:
+                self.no_face += 1
+                return
+
+            y = np.array([point])
+            if self._prompt_num % self.holdout_every == 0:
+                self.holdout_x.append(x)
+                self.holdout_y.append(point)
+            else:
+                self.model.update(x[None, :], y)
+                cx = min(int(point[0] * self.grid), self.grid - 1)
+                cy = min(int(point[1] * self.grid), self.grid - 1)
+                self.coverage[cy, cx] += 1
+
+            if self.holdout_x and self.model.n and (self.model.n + len(self.holdout_x)) % 10 == 0:
+                pred = self.model.predict(np.array(self.holdout_x))
+                self.error = float(np.linalg.norm(pred - np.array(self.holdout_y), axis=1).mean())
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "train": self.model.n,
+                "holdout": len(self.holdout_x),
+                "error": self.error,
+                "coverage": self.coverage.copy(),
+                "no_face": self.no_face,
+                "dropped": self.dropped
+            }
+
+
+class GazePreviewWidget(QWidget):
+    """
+    Shows the held out error of a GazePreview and a heatmap of the screen locations covered so far
+    """
+
+    def __init__(self, preview: GazePreview, *args, **kwargs):
+        super(GazePreviewWidget, self).__init__(*args, **kwargs)
+        self.preview = preview
+        self.setMinimumSize(200, 240)
+
+        self.timer = QtCore.QTimer(self)
+        # noinspection PyUnresolvedReferences
+        self.timer.timeout.connect(self.update)
+        self.timer.start(500)
+
+    def paintEvent(self, e: QtGui.QPaintEvent) -> None:
+        snap = self.preview.snapshot()
+        painter = QtGui.QPainter(self)
+
+        text_height = 40
+        w = self.width()
+        h = self.height() - text_height
+        coverage = snap["coverage"]
+        peak = max(int(coverage.max()), 1)
+        n = len(coverage)
+        for i in range(n):
+            for j in range(n):
+                v = int(255 * coverage[i, j] / peak)
+                rect = QtCore.QRect(j * w // n, i * h // n, w // n + 1, h // n + 1)
+                painter.fillRect(rect, QtGui.QColor(v, 0, 255 - v))
+
+        if snap["error"] is None:
+            error = "n/a"
+        else:
+            error = "%.3f" % snap["error"]
+        painter.setPen(QtGui.QColor(Qt.black))
+        painter.drawText(
+            QtCore.QRect(0, h, w, text_height),
+            Qt.AlignLeft | Qt.AlignVCenter,
+            "held out error: %s\ntrain: %d  holdout: %d  no face: %d" % (
+                error, snap["train"], snap["holdout"], snap["no_face"])
+        )
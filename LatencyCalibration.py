@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import random
+import threading
+from bisect import bisect_right
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from PyQt5 import QtGui
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QWidget
+from PyQt5.QtGui import QKeyEvent
+from PyQt5.QtCore import Qt
+
+from CameraBroker import CameraBroker
+
+LATENCY_FILE = "latency.json"
+
+
+def save_latency(disk_dir: str, stats: dict) -> None:
+    with open(os.path.join(disk_dir, LATENCY_FILE), "w") as f:
+        json.dump(stats, f, indent=4)
+
+
+def load_latency_offset(disk_dir: str) -> float:
+    """
+    :param disk_dir: The application data directory
+    :return: the median display to capture latency in seconds measured by the last calibration, 0 if never calibrated
+    """
+    path = os.path.join(disk_dir, LATENCY_FILE)
+    if not os.path.isfile(path):
+        return 0.0
+    with open(path) as f:
+        return json.load(f)["median"]
+
+
+class PromptHistory:
+    """
+    Remembers when each prompt was shown, so that a frame can be labelled with the prompt that was on screen when
+    the frame was exposed rather than when it was read
+    """
+
+    def __init__(self, offset: float = 0.0, max_len: int = 16):
+        """
+        :param offset: The display to capture latency in seconds
+        :param max_len: The number of prompts remembered
+        """
+        self.offset = offset
+        self.max_len = max_len
+        self._times = []
+        self._points = []
+
+    def add(self, t: float, point: Tuple[float, float]) -> None:
+        self._times.append(t)
+        self._points.append(point)
+        if len(self._times) > self.max_len:
+            del self._times[0]
+            del self._points[0]
+
+    def at(self, t: float) -> Optional[Tuple[float, float]]:
+        """
+        :param t: The time a frame was read
+        :return: the prompt on screen when the frame was exposed, None if no prompt was shown yet
+        """
+        i = bisect_right(self._times, t - self.offset)
+        if i == 0:
+            return None
+        return self._points[i - 1]
+
+
+class LatencyEstimator:
+    """
+    Matches brightness transitions seen by the camera to the flashes shown on screen
+    """
+
+    def __init__(self, max_latency: float = 1.0):
+        self.max_latency = max_latency
+        self.flashes = []
+        self.frames = []
+
+    def add_flash(self, t: float, level: int) -> None:
+        """
+        :param t: The time the flash was drawn
+        :param level: 1 for a white screen, 0 for a black screen
+        """
+        self.flashes.append((t, level))
+
+    def add_frame(self, t: float, brightness: float) -> None:
+        """
+        :param t: The time the frame was read
+        :param brightness: The mean intensity of the frame
+        """
+        self.frames.append((t, brightness))
+
+    def latencies(self) -> List[float]:
+        if len(self.frames) < 2 or not self.flashes:
+            return []
+
+        times = np.array([e[0] for e in self.frames])
+        brightness = np.array([e[1] for e in self.frames])
+        lo, hi = np.percentile(brightness, [10, 90])
+        if hi - lo < 1:
+            return []
+        levels = (brightness > (lo + hi) / 2).astype(np.int64)
+
+        flash_times = [e[0] for e in self.flashes]
+        result = []
+        for i in np.nonzero(np.diff(levels))[0] + 1:
+            t = times[i]
+            j = bisect_right(flash_times, t) - 1
+            if j < 0 or self.flashes[j][1] != levels[i]:
+                continue
+            latency = t - flash_times[j]
+            if 0 < latency < self.max_latency:
+                result.append(float(latency))
+        return result
+
+    def stats(self) -> Optional[dict]:
+        latencies = self.latencies()
+        if not latencies:
+            return None
+        p10, median, p90 = np.percentile(latencies, [10, 50, 90])
+        return {
+            "median": float(median),
+            "mean": float(np.mean(latencies)),
+            "p10": float(p10),
+            "p90": float(p90),
+            "count": len(latencies),
+            "measured": time.time()
+        }
+
+
+class CalibrationPrompt(QWidget):
+    """
+    Full screen widget which flashes between black and white while the camera measures when each flash arrives
+
+    The subject should sit in front of the screen as they would during collection, the camera picks up the light of
+    the screen reflected off of their face
+    """
+
+    def __init__(self, disk_dir: str, broker: CameraBroker, flashes: int = 20, *args, **kwargs):
+        super(CalibrationPrompt, self).__init__(*args, **kwargs)
+        self.setCursor(Qt.BlankCursor)
+
+        self.disk_dir = disk_dir
+        self.broker = broker
+        self.flashes = flashes
+        self.estimator = LatencyEstimator()
+        self.level = 0
+        self._flashNum = 0
+        self._pendingFlash = False
+        self._running = False
+        self._thread = None
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        # noinspection PyUnresolvedReferences
+        self.timer.timeout.connect(self.on_timer)
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(target=self.collectFrames)
+        self._thread.start()
+        # Leaves time for the camera to settle before the first flash
+        self.timer.start(1500)
+
+    def collectFrames(self) -> None:
+        # Downscaled by the broker, the mean brightness is all that is needed
+        subscription = self.broker.subscribe(size=(64, 48), max_queue=32)
+        while self._running:
+            e = subscription.get(timeout=0.1)
+            if e is None:
+                continue
+            t, frame = e
+            self.estimator.add_frame(t, float(frame.array.mean()))
+            frame.release()
+        subscription.close()
+
+    def on_timer(self) -> None:
+        if self._flashNum >= self.flashes:
+            self.finish()
+            return
+        self._flashNum += 1
+        self.level = 1 - self.level
+        self._pendingFlash = True
+        self.update()
+        # Random intervals keep the flashes from aliasing with the frame rate of the camera
+        self.timer.start(random.randint(400, 800))
+
+    def finish(self) -> None:
+        self._running = False
+        self._thread.join()
+
+        stats = self.estimator.stats()
+        if stats is None:
+            print("Latency calibration failed: no flashes were detected by the camera")
+        else:
+            save_latency(self.disk_dir, stats)
+            print("Display to capture latency: median %.1fms, p10 %.1fms, p90 %.1fms (%d flashes)" % (
+                stats["median"] * 1000, stats["p10"] * 1000, stats["p90"] * 1000, stats["count"]))
+        self.close()
+
+    def paintEvent(self, e: QtGui.QPaintEvent) -> None:
+        painter = QtGui.QPainter(self)
+        rect = QtCore.QRect(0, 0, painter.device().width(), painter.device().height())
+        painter.fillRect(rect, QtGui.QColor("white" if self.level else "black"))
+        painter.end()
+        if self._pendingFlash:
+            self._pendingFlash = False
+            self.estimator.add_flash(time.time(), self.level)
+
+    def keyPressEvent(self, e: QKeyEvent) -> None:
+        if e.key() == Qt.Key_Escape:
+            self.timer.stop()
+            self._running = False
+            if self._thread is not None:
+                self._thread.join()
+            self.close()
@@ -0,0 +1,330 @@
+import os
+import time
+import queue
+import random
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+from typing import Callable
+from typing import Optional
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from Serialization import fanout_status_path
+from Serialization import serializer_from_config
+from Serialization import recover_journals
+from LatencyCalibration import PromptHistory
+
+# Seconds the camera is given to deliver its first frame, webcams often fail their first reads while warming up
+CAMERA_WARMUP = 10.0
+
+
+class FrameRing:
+    """
+    Fixed number of frame slots in shared memory, which processes exchange by slot index instead of pickling frames
+    """
+
+    def __init__(self, shape: Tuple[int, ...], dtype: str, slots: int, name: Optional[str] = None):
+        """
+        :param shape: The shape of a single frame
+        :param dtype: The numpy dtype string of a frame, ex. "|u1"
+        :param slots: The number of frames in the ring
+        :param name: The name of an existing ring to attach to, a new ring is created if None
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+
+        size = slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.frames = np.ndarray((slots,) + self.shape, self.dtype, buffer=self.shm.buf)
+
+    def spec(self) -> tuple:
+        """
+        :return: the arguments needed to attach to the ring from another process
+        """
+        return self.shape, self.dtype.str, self.slots, self.shm.name
+
+    def close(self) -> None:
+        del self.frames
+        self.shm.close()
+
+
+def capture_process(
+        cycle_length: float,
+        latency_offset: float,
+        free_slots: mp.Queue,
+        work: mp.Queue,
+        events: mp.Queue,
+        ring_specs: mp.Queue,
+        stop: mp.Event,
+        n_encoders: int
+) -> None:
+    """
+    Owns the camera and the prompt schedule.  Frames are read straight into free slots of the ring and the slot
+    indices are handed to the encoders
+    """
+    cap = cv2.VideoCapture(0)
+    deadline = time.time() + CAMERA_WARMUP
+    while True:
+        ret, frame = cap.read()
+        if ret:
+            break
+        if stop.is_set() or time.time() > deadline:
+            events.put(("error", "Failed to read from the camera"))
+            for _ in range(n_encoders):
+                work.put(None)
+            cap.release()
+            return
+        time.sleep(0.1)
+
+    events.put(("shape", frame.shape, frame.dtype.str))
+    ring = FrameRing(*ring_specs.get())
+
+    history = PromptHistory(latency_offset)
+    start = time.time()
+    cycle_num = 1
+    point = (random.uniform(0, 1), random.uniform(0, 1))
+    history.add(time.time(), point)
+    events.put(("prompt", point))
+
+    captured = 0
+    dropped = 0
+    last_report = time.time()
+    while not stop.is_set():
+        now = time.time()
+        if now > start + cycle_num * cycle_length:
+            cycle_num += 1
+            point = (random.uniform(0, 1), random.uniform(0, 1))
+            history.add(now, point)
+            events.put(("prompt", point))
+
+        if now - last_report > 1:
+            events.put(("capture", captured, dropped))
+            last_report = now
+
+        try:
+            i = free_slots.get_nowait()
+        except queue.Empty:
+            # Every slot is still being encoded, the frame is read and discarded to keep the camera buffer fresh
+            cap.grab()
+            dropped += 1
+            continue
+
+        ret, _ = cap.read(image=ring.frames[i])
+        t = time.time()
+        label_point = history.at(t)
+        if not ret or label_point is None:
+            free_slots.put(i)
+            continue
+
+        captured += 1
+        work.put((i, label_point, t, {"timestamp": t - latency_offset, "latency_offset": latency_offset}))
+
+    events.put(("capture", captured, dropped))
+    for _ in range(n_encoders):
+        work.put(None)
+    cap.release()
+    ring.close()
+
+
+def encoder_process(config: dict, ring_spec: tuple, free_slots: mp.Queue, work: mp.Queue, events: mp.Queue) -> None:
+    """
+    Preprocesses, encodes and writes the frames handed over by the capture process
+    """
+    if config["type"] == "Multi":
+        # Buffered appends of several encoders to one status file interleave mid line, each keeps its own file
+        config = dict(config, status_path=fanout_status_path(config, os.getpid()))
+    # Recovery already ran in the GUI process, the other encoders are writing to the same directory
+    serializer = serializer_from_config(config, recover=False)
+    ring = FrameRing(*ring_spec)
+
+    written = 0
+    failed = 0
+    last_report = time.time()
+    while True:
+        e = work.get()
+        if e is None:
+            break
+        i, point, t, extra = e
+        try:
+            # Named from the capture time, the clocks of the encoders would collide and lose the capture order
+            serializer.handle_data(point, ring.frames[i], extra, t)
+            written += 1
+        except Exception as ex:
+            print("Failed to write sample: %s" % ex)
+            failed += 1
+        finally:
+            free_slots.put(i)
+
+        if time.time() - last_report > 1:
+            events.put(("written", os.getpid(), written, failed))
+            last_report = time.time()
+
+    serializer.close()
+    events.put(("written", os.getpid(), written, failed))
+    ring.close()
+
+
+class MultiProcessSession:
+    """
+    Runs the capture loop and the encoders in separate processes, so that they do not share the GIL with the GUI
+
+    The GUI process only receives prompt events and metrics, and must call poll() regularly, ex. from a QTimer
+    """
+
+    def __init__(
+            self,
+            config: dict,
+            cycle_length: float,
+            latency_offset: float = 0.0,
+            n_encoders: Optional[int] = None,
+            slots: int = 16,
+            on_prompt: Optional[Callable[[Tuple[float, float]], None]] = None
+    ):
+        """
+        :param config: The output configuration, see TargetOptions.get_config()
+        :param cycle_length: Seconds between prompts
+        :param latency_offset: The display to capture latency in seconds
+        :param n_encoders: Number of encoder processes, defaults to the number of cores minus the GUI and capture
+        :param slots: Number of frames in the shared memory ring
+        :param on_prompt: Called in the GUI process with every new prompt location
+        """
+        if n_encoders is None:
+            n_encoders = max(1, (os.cpu_count() or 3) - 2)
+        self.config = config
+        self.cycle_length = cycle_length
+        self.latency_offset = latency_offset
+        self.n_encoders = n_encoders
+        self.slots = slots
+        self.on_prompt = on_prompt
+
+        self.free_slots = mp.Queue()
+        self.work = mp.Queue()
+        self.events = mp.Queue()
+        self.ring_specs = mp.Queue()
+        self.stop_event = mp.Event()
+
+        self.ring = None
+        self.capture = None
+        self.encoders = []
+
+        self.captured = 0
+        self.dropped = 0
+        self.written = {}
+        self.failed = {}
+        self.error = None
+
+    def start(self) -> None:
+        if os.name == "posix":
+            # The children must share the resource tracker of this process, otherwise a child attaching to the ring
+            # starts its own tracker which unlinks the ring as soon as that child exits
+            resource_tracker.ensure_running()
+        targets = [self.config]
+        if self.config["type"] == "Multi":
+            targets = list(self.config["target_configs"].values())
+        for e in targets:
+            if e["type"] == "Disk":
+                recover_journals(e["base_dir"])
+        self.capture = mp.Process(
+            target=capture_process,
+            args=(
+                self.cycle_length,
+                self.latency_offset,
+                self.free_slots,
+                self.work,
+                self.events,
+                self.ring_specs,
+                self.stop_event,
+                self.n_encoders
+            )
+        )
+        self.capture.start()
+
+    def poll(self) -> None:
+        """
+        Handles the events sent by the capture and encoder processes
+        """
+        while True:
+            try:
+                e = self.events.get_nowait()
+            except queue.Empty:
+                return
+
+            if e[0] == "shape":
+                self.start_encoders(e[1], e[2])
+            elif e[0] == "prompt":
+                if self.on_prompt is not None:
+                    self.on_prompt(e[1])
+            elif e[0] == "capture":
+                self.captured, self.dropped = e[1], e[2]
+            elif e[0] == "written":
+                self.written[e[1]] = e[2]
+                self.failed[e[1]] = e[3]
+            elif e[0] == "error":
+                self.error = e[1]
+                print(self.error)
+
+    def start_encoders(self, shape: Tuple[int, ...], dtype: str) -> None:
+        self.ring = FrameRing(shape, dtype, self.slots)
+        for i in range(self.slots):
+            self.free_slots.put(i)
+
+        for _ in range(self.n_encoders):
+            p = mp.Process(
+                target=encoder_process,
+                args=(self.config, self.ring.spec(), self.free_slots, self.work, self.events)
+            )
+            p.start()
+            self.encoders.append(p)
+        self.ring_specs.put(self.ring.spec())
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """
+        Stops capturing and waits for the encoders to write every captured frame.  Processes still running after the
+        timeout are terminated, the journals of their disk outputs are recovered when the next session starts
+
+        :param timeout: Seconds to wait for the capture and encoder processes
+        """
+        self.stop_event.set()
+        deadline = time.time() + timeout
+        processes = self.encoders
+        if self.capture is not None:
+            processes = [self.capture] + processes
+            # The capture process may still be waiting on the ring, which is only created by poll()
+            while self.capture.is_alive() and time.time() < deadline:
+                self.poll()
+                self.capture.join(0.1)
+        for p in self.encoders:
+            while p.is_alive() and time.time() < deadline:
+                self.poll()
+                p.join(min(0.1, max(deadline - time.time(), 0.0)))
+
+        terminated = 0
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+                p.join()
+                terminated += 1
+        if terminated:
+            print("Terminated %d processes which did not stop within %.1fs" % (terminated, timeout))
+        self.poll()
+
+        if self.ring is not None:
+            self.ring.close()
+            self.ring.shm.unlink()
+            self.ring = None
+
+    def metrics(self) -> dict:
+        return {
+            "captured": self.captured,
+            "dropped": self.dropped,
+            "written": sum(self.written.values()),
+            "failed": sum(self.failed.values()),
+            "encoders": self.n_encoders
+        }
@@ -2,11 +2,13 @@ import os
 import json
 from typing import Optional
 from functools import wraps
+from functools import partial
 
 from PyQt5.QtWidgets import QVBoxLayout
 from PyQt5.QtWidgets import QHBoxLayout
 from PyQt5.QtWidgets import QPushButton
 from PyQt5.QtWidgets import QComboBox
+from PyQt5.QtWidgets import QCheckBox
 from PyQt5.QtWidgets import QLineEdit
 from PyQt5.QtWidgets import QLabel
 from PyQt5.QtWidgets import QWidget
@@ -15,8 +17,17 @@ from PyQt5.QtWidgets import QFileDialog
 from PyQt5.QtCore import Qt
 
 from Serialization import Serializer
-from Serialization import DiskSerializer
-from Serialization import S3Serializer
+from Serialization import serializer_from_config
+from Serialization import DURABILITY_POLICIES
+from Serialization import default_durability_config
+from Serialization import KEY_LAYOUTS
+from Serialization import default_station_id
+from FrameQuality import QUALITY_ACTIONS
+from FrameQuality import default_quality_config
+from Preprocessing import INTERPOLATIONS
+from Preprocessing import COLOR_MODES
+from Preprocessing import NORMALIZATIONS
+from Preprocessing import default_preprocess_config
 
 documents_dir = os.path.join(os.path.expanduser("~"), "Documents")
 
@@ -56,6 +67,13 @@ class TargetOptions(QWidget):
         """
         raise NotImplementedError()
 
+    def get_session_config(self):
+        """
+        Serializes the options along with everything needed to create the serializer from them in another process
+        :return: json representation of the options
+        """
+        return self.get_config()
+
     def create_serializer(self) -> Serializer:
         """
         Creates and returns the appropriate serializer for the target options
@@ -63,6 +81,281 @@ class TargetOptions(QWidget):
         raise NotImplementedError()
 
 
+class QualityOptions(QWidget):
+    """
+    Widget for managing the frame quality checks of an output target
+    """
+    def __init__(self, data=None):
+        """
+        :param data: the "quality" entry of a configuration, defaults are used if None
+        """
+        super(QualityOptions, self).__init__()
+
+        self.config = default_quality_config()
+        if data is not None:
+            self.config.update(data)
+
+        action_lbl = QLabel("Frame quality checks: ")
+        self.action_select = QComboBox()
+        for e in QUALITY_ACTIONS:
+            self.action_select.addItem(e)
+        self.action_select.setCurrentIndex(QUALITY_ACTIONS.index(self.config["action"]))
+
+        action_layout = QHBoxLayout()
+        action_layout.addWidget(action_lbl)
+        action_layout.addWidget(self.action_select)
+        action_widget = QWidget()
+        action_widget.setLayout(action_layout)
+
+        sharpness_lbl = QLabel("Minimum sharpness: ")
+        self.sharpness_box = QLineEdit(str(self.config["min_sharpness"]))
+
+        sharpness_layout = QHBoxLayout()
+        sharpness_layout.addWidget(sharpness_lbl)
+        sharpness_layout.addWidget(self.sharpness_box)
+        sharpness_widget = QWidget()
+        sharpness_widget.setLayout(sharpness_layout)
+
+        clipped_lbl = QLabel("Maximum clipped fraction: ")
+        self.clipped_box = QLineEdit(str(self.config["max_clipped"]))
+
+        clipped_layout = QHBoxLayout()
+        clipped_layout.addWidget(clipped_lbl)
+        clipped_layout.addWidget(self.clipped_box)
+        clipped_widget = QWidget()
+        clipped_widget.setLayout(clipped_layout)
+
+        self.face_box = QCheckBox("Require a face")
+        self.face_box.setChecked(self.config["require_face"])
+
+        layout = QVBoxLayout()
+        layout.addWidget(action_widget)
+        layout.addWidget(sharpness_widget)
+        layout.addWidget(clipped_widget)
+        layout.addWidget(self.face_box)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+
+        self.set_connections()
+
+    # noinspection PyUnresolvedReferences
+    def set_connections(self):
+        self.action_select.currentIndexChanged.connect(self.on_action_select)
+        self.sharpness_box.returnPressed.connect(self.on_sharpness_box)
+        self.clipped_box.returnPressed.connect(self.on_clipped_box)
+        self.face_box.toggled.connect(self.on_face_box)
+
+    def get_config(self):
+        return dict(self.config)
+
+    def on_action_select(self, i: int):
+        self.config["action"] = QUALITY_ACTIONS[i]
+
+    def on_sharpness_box(self):
+        try:
+            self.config["min_sharpness"] = float(self.sharpness_box.text())
+        except ValueError:
+            self.sharpness_box.setText(str(self.config["min_sharpness"]))
+
+    def on_clipped_box(self):
+        try:
+            self.config["max_clipped"] = float(self.clipped_box.text())
+        except ValueError:
+            self.clipped_box.setText(str(self.config["max_clipped"]))
+
+    def on_face_box(self, checked: bool):
+        self.config["require_face"] = checked
+
+
+class PreprocessOptions(QWidget):
+    """
+    Widget for managing the transformations applied to frames before they are encoded
+    """
+    def __init__(self, data=None):
+        """
+        :param data: the "preprocess" entry of a configuration, defaults are used if None
+        """
+        super(PreprocessOptions, self).__init__()
+
+        self.config = default_preprocess_config()
+        if data is not None:
+            self.config.update(data)
+        self.interpolations = list(INTERPOLATIONS)
+
+        size_lbl = QLabel("Frame size (0 keeps camera size): ")
+        self.width_box = QLineEdit(str(self.config["width"]))
+        self.width_box.setMaximumWidth(50)
+        self.height_box = QLineEdit(str(self.config["height"]))
+        self.height_box.setMaximumWidth(50)
+
+        size_layout = QHBoxLayout()
+        size_layout.addWidget(size_lbl)
+        size_layout.addWidget(self.width_box)
+        size_layout.addWidget(QLabel("x"))
+        size_layout.addWidget(self.height_box)
+        size_widget = QWidget()
+        size_widget.setLayout(size_layout)
+
+        interpolation_lbl = QLabel("Interpolation: ")
+        self.interpolation_select = QComboBox()
+        for e in self.interpolations:
+            self.interpolation_select.addItem(e)
+        self.interpolation_select.setCurrentIndex(self.interpolations.index(self.config["interpolation"]))
+
+        interpolation_layout = QHBoxLayout()
+        interpolation_layout.addWidget(interpolation_lbl)
+        interpolation_layout.addWidget(self.interpolation_select)
+        interpolation_widget = QWidget()
+        interpolation_widget.setLayout(interpolation_layout)
+
+        color_lbl = QLabel("Color: ")
+        self.color_select = QComboBox()
+        for e in COLOR_MODES:
+            self.color_select.addItem(e)
+        self.color_select.setCurrentIndex(COLOR_MODES.index(self.config["color"]))
+
+        color_layout = QHBoxLayout()
+        color_layout.addWidget(color_lbl)
+        color_layout.addWidget(self.color_select)
+        color_widget = QWidget()
+        color_widget.setLayout(color_layout)
+
+        normalize_lbl = QLabel("Normalization: ")
+        self.normalize_select = QComboBox()
+        for e in NORMALIZATIONS:
+            self.normalize_select.addItem(e)
+        self.normalize_select.setCurrentIndex(NORMALIZATIONS.index(self.config["normalize"]))
+
+        normalize_layout = QHBoxLayout()
+        normalize_layout.addWidget(normalize_lbl)
+        normalize_layout.addWidget(self.normalize_select)
+        normalize_widget = QWidget()
+        normalize_widget.setLayout(normalize_layout)
+
+        layout = QVBoxLayout()
+        layout.addWidget(size_widget)
+        layout.addWidget(interpolation_widget)
+        layout.addWidget(color_widget)
+        layout.addWidget(normalize_widget)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+
+        self.set_connections()
+
+    # noinspection PyUnresolvedReferences
+    def set_connections(self):
+        self.width_box.returnPressed.connect(self.on_width_box)
+        self.height_box.returnPressed.connect(self.on_height_box)
+        self.interpolation_select.currentIndexChanged.connect(self.on_interpolation_select)
+        self.color_select.currentIndexChanged.connect(self.on_color_select)
+        self.normalize_select.currentIndexChanged.connect(self.on_normalize_select)
+
+    def get_config(self):
+        return dict(self.config)
+
+    def on_width_box(self):
+        new_width = self.width_box.text()
+        if new_width.isdigit():
+            self.config["width"] = int(new_width)
+        else:
+            self.width_box.setText(str(self.config["width"]))
+
+    def on_height_box(self):
+        new_height = self.height_box.text()
+        if new_height.isdigit():
+            self.config["height"] = int(new_height)
+        else:
+            self.height_box.setText(str(self.config["height"]))
+
+    def on_interpolation_select(self, i: int):
+        self.config["interpolation"] = self.interpolations[i]
+
+    def on_color_select(self, i: int):
+        self.config["color"] = COLOR_MODES[i]
+
+    def on_normalize_select(self, i: int):
+        self.config["normalize"] = NORMALIZATIONS[i]
+
+
+class DurabilityOptions(QWidget):
+    """
+    Widget for managing when samples written to disk are flushed to stable storage
+    """
+    def __init__(self, data=None):
+        """
+        :param data: the "durability" entry of a configuration, defaults are used if None
+        """
+        super(DurabilityOptions, self).__init__()
+
+        self.config = default_durability_config()
+        if data is not None:
+            self.config.update(data)
+
+        policy_lbl = QLabel("Flush to disk: ")
+        self.policy_select = QComboBox()
+        for e in DURABILITY_POLICIES:
+            self.policy_select.addItem(e)
+        self.policy_select.setCurrentIndex(DURABILITY_POLICIES.index(self.config["policy"]))
+
+        policy_layout = QHBoxLayout()
+        policy_layout.addWidget(policy_lbl)
+        policy_layout.addWidget(self.policy_select)
+        policy_widget = QWidget()
+        policy_widget.setLayout(policy_layout)
+
+        frames_lbl = QLabel("Frames per flush: ")
+        self.frames_box = QLineEdit(str(self.config["frames"]))
+
+        frames_layout = QHBoxLayout()
+        frames_layout.addWidget(frames_lbl)
+        frames_layout.addWidget(self.frames_box)
+        frames_widget = QWidget()
+        frames_widget.setLayout(frames_layout)
+
+        interval_lbl = QLabel("Seconds per flush: ")
+        self.interval_box = QLineEdit(str(self.config["interval"]))
+
+        interval_layout = QHBoxLayout()
+        interval_layout.addWidget(interval_lbl)
+        interval_layout.addWidget(self.interval_box)
+        interval_widget = QWidget()
+        interval_widget.setLayout(interval_layout)
+
+        layout = QVBoxLayout()
+        layout.addWidget(policy_widget)
+        layout.addWidget(frames_widget)
+        layout.addWidget(interval_widget)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(layout)
+
+        self.set_connections()
+
+    # noinspection PyUnresolvedReferences
+    def set_connections(self):
+        self.policy_select.currentIndexChanged.connect(self.on_policy_select)
+        self.frames_box.returnPressed.connect(self.on_frames_box)
+        self.interval_box.returnPressed.connect(self.on_interval_box)
+
+    def get_config(self):
+        return dict(self.config)
+
+    def on_policy_select(self, i: int):
+        self.config["policy"] = DURABILITY_POLICIES[i]
+
+    def on_frames_box(self):
+        new_frames = self.frames_box.text()
+        if new_frames.isdigit() and int(new_frames) > 0:
+            self.config["frames"] = int(new_frames)
+        else:
+            self.frames_box.setText(str(self.config["frames"]))
+
+    def on_interval_box(self):
+        try:
+            self.config["interval"] = float(self.interval_box.text())
+        except ValueError:
+            self.interval_box.setText(str(self.config["interval"]))
+
+
 class DiskTargetOptions(TargetOptions):
     """
     Widget for managing the options for a disk target
@@ -79,12 +372,18 @@ class DiskTargetOptions(TargetOptions):
             self.img_fmt = "YYYYMMDD/hhmmss-sss"
             self.lbl_dir = "labels"
             self.lbl_fmt = "YYYYMMDD/hhmmss-sss"
+            self.quality = None
+            self.preprocess = None
+            self.durability = None
         else:
             self.base_dir = data["base_dir"]
             self.img_dir = data["img_dir"]
             self.img_fmt = data["img_fmt"]
             self.lbl_dir = data["lbl_dir"]
             self.lbl_fmt = data["lbl_fmt"]
+            self.quality = data.get("quality")
+            self.preprocess = data.get("preprocess")
+            self.durability = data.get("durability")
 
         self.base_dir_box = QLineEdit(self.base_dir)
         self.base_dir_browse = QPushButton("...")
@@ -132,6 +431,10 @@ class DiskTargetOptions(TargetOptions):
         lbl_fmt_widget = QWidget()
         lbl_fmt_widget.setLayout(lbl_fmt_layout)
 
+        self.quality_options = QualityOptions(self.quality)
+        self.preprocess_options = PreprocessOptions(self.preprocess)
+        self.durability_options = DurabilityOptions(self.durability)
+
         layout = QVBoxLayout()
         layout.addWidget(QLabel("Disk Output Options"))
         layout.addWidget(base_dir_widget)
@@ -139,6 +442,9 @@ class DiskTargetOptions(TargetOptions):
         layout.addWidget(img_fmt_widget)
         layout.addWidget(lbl_dir_widget)
         layout.addWidget(lbl_fmt_widget)
+        layout.addWidget(self.quality_options)
+        layout.addWidget(self.preprocess_options)
+        layout.addWidget(self.durability_options)
         self.setLayout(layout)
 
         self.set_connections()
@@ -159,17 +465,14 @@ class DiskTargetOptions(TargetOptions):
             "img_dir": self.img_dir,
             "img_fmt": self.img_fmt,
             "lbl_dir": self.lbl_dir,
-            "lbl_fmt": self.lbl_fmt
+            "lbl_fmt": self.lbl_fmt,
+            "quality": self.quality_options.get_config(),
+            "preprocess": self.preprocess_options.get_config(),
+            "durability": self.durability_options.get_config()
         }
 
     def create_serializer(self) -> Serializer:
-        return DiskSerializer(
-            self.base_dir,
-            self.img_dir,
-            self.img_fmt,
-            self.lbl_dir,
-            self.lbl_fmt
-        )
+        return serializer_from_config(self.get_config())
 
     def on_base_dir_box(self):
         new_base_dir = self.base_dir_box.text()
@@ -222,6 +525,11 @@ class S3TargetOptions(TargetOptions):
             self.img_fmt = ""
             self.lbl_dir = ""
             self.lbl_fmt = ""
+            self.quality = None
+            self.preprocess = None
+            self.key_layout = "date"
+            self.station_id = default_station_id()
+            self.manifest_dir = "manifests"
         else:
             self.access_key_id = data["access_key"]
             self.secret_access_key = data["secret_key"]
@@ -230,6 +538,11 @@ class S3TargetOptions(TargetOptions):
             self.img_fmt = data["img_fmt"]
             self.lbl_dir = data["lbl_dir"]
             self.lbl_fmt = data["lbl_fmt"]
+            self.quality = data.get("quality")
+            self.preprocess = data.get("preprocess")
+            self.key_layout = data.get("key_layout", "date")
+            self.station_id = data.get("station_id", default_station_id())
+            self.manifest_dir = data.get("manifest_dir", "manifests")
 
         access_key_label = QLabel("Access Key ID:")
         self.access_key_box = QLineEdit(self.access_key_id)
@@ -294,6 +607,30 @@ class S3TargetOptions(TargetOptions):
         lbl_fmt_widget = QWidget()
         lbl_fmt_widget.setLayout(lbl_fmt_layout)
 
+        key_layout_lbl = QLabel("Key layout: ")
+        self.key_layout_select = QComboBox()
+        for e in KEY_LAYOUTS:
+            self.key_layout_select.addItem(e)
+        self.key_layout_select.setCurrentIndex(KEY_LAYOUTS.index(self.key_layout))
+
+        key_layout_layout = QHBoxLayout()
+        key_layout_layout.addWidget(key_layout_lbl)
+        key_layout_layout.addWidget(self.key_layout_select)
+        key_layout_widget = QWidget()
+        key_layout_widget.setLayout(key_layout_layout)
+
+        station_id_lbl = QLabel("Station ID: ")
+        self.station_id_box = QLineEdit(self.station_id)
+
+        station_id_layout = QHBoxLayout()
+        station_id_layout.addWidget(station_id_lbl)
+        station_id_layout.addWidget(self.station_id_box)
+        station_id_widget = QWidget()
+        station_id_widget.setLayout(station_id_layout)
+
+        self.quality_options = QualityOptions(self.quality)
+        self.preprocess_options = PreprocessOptions(self.preprocess)
+
         layout = QVBoxLayout()
         layout.addWidget(QLabel("S3"))
         layout.addWidget(access_key_widget)
@@ -303,6 +640,10 @@ class S3TargetOptions(TargetOptions):
         layout.addWidget(img_fmt_widget)
         layout.addWidget(lbl_dir_widget)
         layout.addWidget(lbl_fmt_widget)
+        layout.addWidget(key_layout_widget)
+        layout.addWidget(station_id_widget)
+        layout.addWidget(self.quality_options)
+        layout.addWidget(self.preprocess_options)
         self.setLayout(layout)
 
         self.set_connections()
@@ -316,6 +657,8 @@ class S3TargetOptions(TargetOptions):
         self.img_fmt_box.returnPressed.connect(self.on_img_fmt_box)
         self.lbl_dir_box.returnPressed.connect(self.on_lbl_dir_box)
         self.lbl_fmt_box.returnPressed.connect(self.on_lbl_fmt_box)
+        self.key_layout_select.currentIndexChanged.connect(self.on_key_layout_select)
+        self.station_id_box.returnPressed.connect(self.on_station_id_box)
 
     def get_config(self):
         return {
@@ -326,25 +669,16 @@ class S3TargetOptions(TargetOptions):
             "img_dir": self.img_dir,
             "img_fmt": self.img_fmt,
             "lbl_dir": self.lbl_dir,
-            "lbl_fmt": self.lbl_fmt
+            "lbl_fmt": self.lbl_fmt,
+            "key_layout": self.key_layout,
+            "station_id": self.station_id,
+            "manifest_dir": self.manifest_dir,
+            "quality": self.quality_options.get_config(),
+            "preprocess": self.preprocess_options.get_config()
         }
 
     def create_serializer(self) -> Serializer:
-        access_key = None
-        secret_key = None
-        if self.access_key_id != "default":
-            access_key = self.access_key_id
-        if self.secret_access_key != "default":
-            secret_key = self.secret_access_key
-        return S3Serializer(
-            self.bucket_name,
-            self.img_dir,
-            self.img_fmt,
-            self.lbl_dir,
-            self.lbl_fmt,
-            access_key,
-            secret_key
-        )
+        return serializer_from_config(self.get_config())
 
     def on_access_key_box(self):
         self.access_key_id = self.access_key_box.text()
@@ -375,6 +709,68 @@ class S3TargetOptions(TargetOptions):
         else:
             self.lbl_fmt_box.setText(self.lbl_fmt)
 
+    def on_key_layout_select(self, i: int):
+        self.key_layout = KEY_LAYOUTS[i]
+
+    def on_station_id_box(self):
+        new_station_id = self.station_id_box.text().strip().strip('/')
+        if new_station_id:
+            self.station_id = new_station_id
+        else:
+            self.station_id_box.setText(self.station_id)
+
+
+class MultiTargetOptions(TargetOptions):
+    """
+    Widget for selecting the configurations a frame is written to at once, the frame is encoded only once
+    """
+    def __init__(self, data=None, configs=None):
+        """
+        :param data: serialized data retrieved from a get_config() call to initialize the widget
+        :param configs: callable returning every configuration by name
+        """
+        super(MultiTargetOptions, self).__init__()
+
+        self.configs = configs if configs is not None else dict
+        if data is None:
+            self.targets = []
+        else:
+            self.targets = list(data["targets"])
+
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel("Write to all of the selected configurations:"))
+        self.target_boxes = {}
+        for name, config in self.configs().items():
+            if config["type"] == "Multi":
+                continue
+            box = QCheckBox(name)
+            box.setChecked(name in self.targets)
+            # noinspection PyUnresolvedReferences
+            box.toggled.connect(self.on_target_box)
+            layout.addWidget(box)
+            self.target_boxes[name] = box
+        self.setLayout(layout)
+
+    def get_config(self):
+        return {
+            "type": "Multi",
+            "targets": self.targets
+        }
+
+    def get_session_config(self):
+        configs = self.configs()
+        config = self.get_config()
+        config["target_configs"] = {name: configs[name] for name in self.targets if name in configs}
+        if not config["target_configs"]:
+            raise ValueError("No output configurations are selected")
+        return config
+
+    def create_serializer(self) -> Serializer:
+        return serializer_from_config(self.get_session_config())
+
+    def on_target_box(self):
+        self.targets = [name for name, box in self.target_boxes.items() if box.isChecked()]
+
 
 class DataOutputOptions(QWidget):
     """
@@ -385,8 +781,8 @@ class DataOutputOptions(QWidget):
         super(DataOutputOptions, self).__init__()
 
         self.disk_dir = disk_dir
-        self.targets = ["Disk", "S3"]
-        self.target_widgets = [DiskTargetOptions, S3TargetOptions]
+        self.targets = ["Disk", "S3", "Multi"]
+        self.target_widgets = [DiskTargetOptions, S3TargetOptions, partial(MultiTargetOptions, configs=self.get_configs)]
 
         # Loading configurations and selecting a current configuration
         self.configs = dict()
@@ -583,6 +979,20 @@ class DataOutputOptions(QWidget):
             self.layout().addWidget(self.target_options)
             self.configs[self.current_config] = self.target_options.get_config()
 
+    def get_configs(self) -> dict:
+        """
+        :return: every configuration by name
+        """
+        return self.configs
+
+    def get_current_config(self) -> dict:
+        """
+        :return: the serialized options of the selected configuration
+        """
+        if not self.current_config:
+            raise ValueError("A configuration is not selected")
+        return self.target_options.get_session_config()
+
     def create_serializer(self) -> Serializer:
         if not self.current_config:
             raise ValueError("A configuration is not selected")
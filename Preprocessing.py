@@ -0,0 +1,93 @@
+from typing import Optional
+
+import cv2
+import numpy as np
+
+INTERPOLATIONS = {
+    "area": cv2.INTER_AREA,
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "nearest": cv2.INTER_NEAREST
+}
+COLOR_MODES = ["color", "gray"]
+NORMALIZATIONS = ["none", "minmax", "equalize"]
+
+
+def default_preprocess_config() -> dict:
+    return {
+        "width": 0,
+        "height": 0,
+        "interpolation": "area",
+        "color": "color",
+        "normalize": "none"
+    }
+
+
+class FramePreprocessor:
+    """
+    Transforms frames once before they are encoded
+
+    The color conversion runs first so the resize and normalization only touch a single channel for grayscale
+    """
+
+    def __init__(
+            self,
+            size: Optional[tuple] = None,
+            interpolation: str = "area",
+            color: str = "color",
+            normalize: str = "none"
+    ):
+        """
+        :param size: The (width, height) of the stored frames, the camera resolution is kept if None
+        :param interpolation: One of INTERPOLATIONS
+        :param color: One of COLOR_MODES
+        :param normalize: "minmax" stretches the intensities to [0, 255], "equalize" equalizes the histogram
+        """
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError("Unknown interpolation: %s" % interpolation)
+        if color not in COLOR_MODES:
+            raise ValueError("Unknown color mode: %s" % color)
+        if normalize not in NORMALIZATIONS:
+            raise ValueError("Unknown normalization: %s" % normalize)
+
+        self.size = size
+        self.interpolation = interpolation
+        self.color = color
+        self.normalize = normalize
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["FramePreprocessor"]:
+        """
+        :param config: The "preprocess" entry of an output configuration
+        :return: the preprocessor, or None if frames are stored as captured
+        """
+        size = None
+        if config["width"] > 0 and config["height"] > 0:
+            size = (config["width"], config["height"])
+        if size is None and config["color"] == "color" and config["normalize"] == "none":
+            return None
+        return cls(size, config["interpolation"], config["color"], config["normalize"])
+
+    def signature(self) -> tuple:
+        """
+        :return: a value equal for preprocessors producing identical frames
+        """
+        return self.size, self.interpolation, self.color, self.normalize
+
+    def __call__(self, frame: np.ndarray) -> np.ndarray:
+        if self.color == "gray" and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        if self.size is not None and (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=INTERPOLATIONS[self.interpolation])
+
+        if self.normalize == "minmax":
+            frame = cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX)
+        elif self.normalize == "equalize":
+            if frame.ndim == 2:
+                frame = cv2.equalizeHist(frame)
+            else:
+                yuv = cv2.cvtColor(frame, cv2.COLOR_BGR2YUV)
+                yuv[:, :, 0] = cv2.equalizeHist(yuv[:, :, 0])
+                frame = cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR)
+        return frame
@@ -0,0 +1,278 @@
+"""
+Uploads the new or changed samples of a local dataset to the bucket of an S3 output configuration
+
+usage: python S3Sync.py <source> <configuration name> [--workers N] [--endpoint-url URL]
+
+<source> is either the base directory of a Disk configuration or a directory of compacted shards.  The sizes and
+modification times of the uploaded files are kept in a state file inside of <source>, so reruns only upload what
+changed since.  --endpoint-url points the client at a local S3 stand-in such as moto_server or MinIO
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from Serialization import cache_dir
+from Serialization import layout_key
+from Serialization import default_station_id
+from Serialization import pair_samples
+from Shards import list_shards
+
+config_dir = os.path.join(os.path.dirname(cache_dir), "DataOutputConfigurations")
+
+
+def load_config(name: str, configs_path: str = config_dir) -> dict:
+    """
+    :param name: The name of an S3 configuration, as shown in the Data Output widget
+    :param configs_path: The directory holding the saved configurations
+    """
+    with open(os.path.join(configs_path, name + ".json")) as f:
+        config = json.load(f)
+    if config["type"] != "S3":
+        raise ValueError("%s is a %s configuration, not an S3 configuration" % (name, config["type"]))
+    return config
+
+
+def create_client(config: dict, endpoint_url: Optional[str] = None):
+    access_key = None
+    secret_key = None
+    if config["access_key"] != "default":
+        access_key = config["access_key"]
+    if config["secret_key"] != "default":
+        secret_key = config["secret_key"]
+    return boto3.client(
+        service_name="s3",
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        endpoint_url=endpoint_url
+    )
+
+
+def plan_uploads(
+        source: str,
+        config: dict,
+        img_dir: str,
+        lbl_dir: str,
+        shard_prefix: str
+) -> List[Tuple[str, str, Optional[str]]]:
+    """
+    Maps every local file of the dataset to its object key
+
+    :return: list of (path relative to source, object key, sample key or None for shard files)
+    """
+    layout = config.get("key_layout", "date")
+    station = config.get("station_id") or default_station_id()
+
+    shards = list_shards(source)
+    if shards:
+        # Only completed shards and the compactor's own indexes, not the caches or files still being written
+        names = ["index.json", "manifest.json"]
+        for e in shards:
+            name = os.path.basename(e)
+            names.append(name[:-len(".idx.json")] + ".bin")
+            names.append(name)
+        files = []
+        for e in sorted(names):
+            if os.path.isfile(os.path.join(source, e)):
+                files.append((e, shard_prefix.replace("\\", '/') + '/' + e, None))
+        return files
+
+    files = []
+    for key, img_path, lbl_path in pair_samples(source, img_dir, lbl_dir):
+        files.append((
+            os.path.relpath(img_path, source),
+            layout_key(layout, config["img_dir"].replace("\\", '/'), key + ".jpg", station),
+            key
+        ))
+        files.append((
+            os.path.relpath(lbl_path, source),
+            layout_key(layout, config["lbl_dir"].replace("\\", '/'), key + ".json", station),
+            key
+        ))
+    return files
+
+
+def load_state(path: str) -> Dict[str, list]:
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path: str, state: Dict[str, list]) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def remote_sizes(client, bucket: str, prefixes: List[str]) -> Dict[str, int]:
+    """
+    Lists the objects already in the bucket under the given prefixes
+    """
+    sizes = {}
+    for prefix in prefixes:
+        for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                sizes[obj["Key"]] = obj["Size"]
+    return sizes
+
+
+def sync(
+        source: str,
+        config: dict,
+        client,
+        img_dir: str = "images",
+        lbl_dir: str = "labels",
+        shard_prefix: str = "shards",
+        workers: int = 16,
+        check_remote: bool = False,
+        dry_run: bool = False
+) -> Tuple[int, int, int]:
+    """
+    :param source: The base directory of a Disk configuration or a directory of shards
+    :param config: The S3 configuration to upload to
+    :param client: A boto3 s3 client
+    :param img_dir: The local image directory relative to source
+    :param lbl_dir: The local label directory relative to source
+    :param shard_prefix: The key prefix shards are uploaded under
+    :param workers: Number of concurrent uploads
+    :param check_remote: Whether to skip files already in the bucket with the same size, useful when the state file
+        was lost or the data was uploaded by other means
+    :param dry_run: Only reports what would be uploaded
+    :return: number of files uploaded, skipped and failed
+    """
+    bucket = config["bucket"]
+    state_path = os.path.join(source, ".s3sync-%s.json" % bucket)
+    state = load_state(state_path)
+
+    files = plan_uploads(source, config, img_dir, lbl_dir, shard_prefix)
+    todo = []
+    for rel_path, key, _ in files:
+        st = os.stat(os.path.join(source, rel_path))
+        if state.get(rel_path) == [key, st.st_size, st.st_mtime_ns]:
+            continue
+        todo.append((rel_path, key, st.st_size, st.st_mtime_ns))
+
+    if check_remote and todo:
+        sizes = remote_sizes(client, bucket, sorted(set(k.split('/')[0] + '/' for _, k, _, _ in todo)))
+        remaining = []
+        for e in todo:
+            if sizes.get(e[1]) == e[2]:
+                state[e[0]] = [e[1], e[2], e[3]]
+            else:
+                remaining.append(e)
+        todo = remaining
+
+    skipped = len(files) - len(todo)
+    print("%d files, %d unchanged, %d to upload" % (len(files), skipped, len(todo)))
+    if dry_run or not todo:
+        save_state(state_path, state)
+        return 0, skipped, 0
+
+    # Shards are large enough to benefit from concurrent multipart uploads, samples are single requests
+    transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=4)
+    start = time.time()
+    uploaded = 0
+    failed = 0
+    n_bytes = 0
+    manifest = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(client.upload_file, os.path.join(source, e[0]), bucket, e[1], Config=transfer_config): e
+            for e in todo
+        }
+        for i, fut in enumerate(as_completed(futures)):
+            rel_path, key, size, mtime = futures[fut]
+            try:
+                fut.result()
+            except Exception as e:
+                failed += 1
+                print("Failed to upload %s: %s" % (rel_path, e))
+                continue
+
+            uploaded += 1
+            n_bytes += size
+            state[rel_path] = [key, size, mtime]
+            if key.endswith(".jpg"):
+                manifest.append((mtime, rel_path, key))
+            if (i + 1) % 1000 == 0:
+                save_state(state_path, state)
+                elapsed = max(time.time() - start, 1e-6)
+                print("[%d/%d] %.1f files/s, %.1f MB/s" % (i + 1, len(todo), uploaded / elapsed, n_bytes / elapsed / 1e6))
+
+    save_state(state_path, state)
+    if manifest and config.get("key_layout", "date") != "date":
+        labels = {sample: key for _, key, sample in files if key.endswith(".json")}
+        samples = {rel_path: sample for rel_path, _, sample in files}
+        upload_manifest(client, config, [(m, k, labels[samples[p]]) for m, p, k in manifest])
+    print("Uploaded %d files (%.1f MB) in %.1fs, %d failed" % (uploaded, n_bytes / 1e6, time.time() - start, failed))
+    return uploaded, skipped, failed
+
+
+def upload_manifest(client, config: dict, samples: List[Tuple[int, str, str]]) -> None:
+    """
+    Uploads a manifest in the format of S3Serializer, so the synced samples can be ordered like collected ones
+
+    :param samples: list of (modification time of the image in ns, image key, label key)
+    """
+    body = "".join(
+        json.dumps({
+            "time": datetime.fromtimestamp(mtime / 1e9).isoformat(),
+            "img": img,
+            "lbl": lbl
+        }) + "\n"
+        for mtime, img, lbl in sorted(samples)
+    )
+    key = "%s/%s/sync-%s-00000.jsonl" % (
+        config.get("manifest_dir", "manifests").replace("\\", '/'),
+        config.get("station_id") or default_station_id(),
+        datetime.today().strftime("%Y%m%d-%H%M%S")
+    )
+    client.upload_fileobj(io.BytesIO(body.encode("utf-8")), config["bucket"], key)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Uploads new or changed samples of a local dataset to S3")
+    parser.add_argument("source", help="The base directory of a Disk configuration or a directory of shards")
+    parser.add_argument("config", help="The name of the S3 configuration to upload to")
+    parser.add_argument("--config-dir", default=config_dir, help="The directory of the saved configurations")
+    parser.add_argument("--img-dir", default="images", help="The local image directory relative to source")
+    parser.add_argument("--lbl-dir", default="labels", help="The local label directory relative to source")
+    parser.add_argument("--shard-prefix", default="shards", help="The key prefix shards are uploaded under")
+    parser.add_argument("--workers", type=int, default=16, help="Number of concurrent uploads")
+    parser.add_argument("--endpoint-url", default=None, help="The url of an S3 compatible endpoint")
+    parser.add_argument("--check-remote", action="store_true", help="Skip files already in the bucket")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be uploaded")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config, args.config_dir)
+    client = create_client(config, args.endpoint_url)
+    _, _, failed = sync(
+        args.source,
+        config,
+        client,
+        args.img_dir,
+        args.lbl_dir,
+        args.shard_prefix,
+        args.workers,
+        args.check_remote,
+        args.dry_run
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
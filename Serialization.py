@@ -2,14 +2,27 @@ import os
 import platform
 import io
 import json
-import platform
+import hashlib
+import time
+import queue
+import threading
 from datetime import datetime
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
 from typing import Tuple
 
 import boto3
 import cv2
 
+from FrameQuality import QualityGate
+from FrameQuality import default_quality_config
+from Preprocessing import FramePreprocessor
+from Preprocessing import default_preprocess_config
+
 plat = platform.system()
 if plat == "Windows":
     cache_dir = os.path.join(os.getenv("APPDATA"), "HSL")
@@ -26,14 +39,13 @@ def get_fmt(fmt: str, d: datetime) -> str:
     :param fmt: The user defined format to be populated
     :return: string representation of the populated format
     """
-    Y = str(d.year)
-    M = str(d.month)
-    D = str(d.day)
-    h = str(d.hour)
-    m = str(d.minute)
-    s = str(d.second) + str(d.microsecond)[:3]
+    Y = "%04d" % d.year
+    M = "%02d" % d.month
+    D = "%02d" % d.day
+    h = "%02d" % d.hour
+    m = "%02d" % d.minute
+    s = "%02d%03d" % (d.second, d.microsecond // 1000)
     fmt = bytearray(fmt, "utf-8")
-    print(fmt, Y, M, D, h, m, s)
     for i in range(len(fmt)):
         if fmt[i] == ord('Y'):
             fmt[i] = ord(Y[0])
@@ -74,14 +86,195 @@ def mkdir_file(file: str) -> None:
 
 
 class Serializer(ABC):
-    @abstractmethod
-    def handle_data(self, point: Tuple[float, float], frame) -> None:
+    quality_gate = None
+    preprocessor = None
+    # Outcome counts of the samples per target, for serializers writing to several targets
+    status = None
+
+    def handle_data(
+            self,
+            point: Tuple[float, float],
+            frame,
+            extra: Optional[dict] = None,
+            t: Optional[float] = None
+    ) -> None:
         """
         Serializes a frame of data to the selected location
 
         :param point: the location on the screen where the person was prompted to look
         :param frame: picture of person looking at point
+        :param extra: additional values stored in the label alongside the point
+        :param t: the time the frame was captured, which names the files.  Defaults to now, which only suits frames
+            written as soon as they are captured
+        """
+        label = {
+            "x": point[0],
+            "y": point[1]
+        }
+        if extra:
+            label.update(extra)
+
+        if self.quality_gate is not None and not self.quality_gate.apply(frame, label):
+            return
+        if self.preprocessor is not None:
+            frame = self.preprocessor(frame)
+
+        ok, img = cv2.imencode(".jpg", frame)
+        if not ok:
+            raise ValueError("Failed to encode frame")
+        self.write_sample(datetime.today() if t is None else datetime.fromtimestamp(t), img.tobytes(), label)
+
+    def warm_up(self, frame) -> None:
+        """
+        Called before the first prompt is shown, so the first samples are not slowed down by one time setup such as
+        opening connections.  The frame is preprocessed and encoded but not written
+
+        :param frame: a frame of the resolution which will be captured
+        """
+        if self.preprocessor is not None:
+            frame = self.preprocessor(frame)
+        cv2.imencode(".jpg", frame)
+
+    def start_session(self, session_id: str) -> None:
+        """
+        Called before the first sample of a session is written
+
+        :param session_id: The ID of the session, which is later passed to write_session
+        """
+
+    def write_session(self, session_id: str, metadata: dict) -> None:
+        """
+        Stores the metadata of a session next to its samples, called once the session ends
+
+        :param session_id: The ID of the session, which is stored in the label of every sample as "session"
+        :param metadata: json serializable description of the session
+        """
+
+    def close(self, timeout: Optional[float] = None) -> None:
         """
+        Called once the session ends, after the last call to handle_data
+
+        :param timeout: Seconds to wait for writes still in progress, unbounded if None
+        """
+
+    @abstractmethod
+    def write_sample(self, d: datetime, img: bytes, label: dict) -> None:
+        """
+        Writes an encoded frame and its label to the selected location
+
+        :param d: the time used to populate the file naming formats
+        :param img: the jpeg encoded frame
+        :param label: the label of the frame
+        """
+
+
+DURABILITY_POLICIES = ["none", "frames", "interval", "session"]
+JOURNAL_PREFIX = ".journal-"
+
+
+def default_durability_config() -> dict:
+    return {
+        "policy": "none",
+        "frames": 100,
+        "interval": 1.0
+    }
+
+
+def fsync_path(path: str) -> None:
+    """
+    Flushes a file, or a directory entry on posix systems, to stable storage
+    """
+    if os.path.isdir(path):
+        if os.name != "posix":
+            return
+        fd = os.open(path, os.O_RDONLY)
+    else:
+        fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sample_complete(img_filename: str, lbl_filename: str) -> bool:
+    """
+    :return: whether both files of a sample were fully written
+    """
+    try:
+        with open(img_filename, "rb") as f:
+            if f.read(2) != b"\xff\xd8":
+                return False
+            f.seek(-2, os.SEEK_END)
+            if f.read(2) != b"\xff\xd9":
+                return False
+        with open(lbl_filename) as f:
+            json.load(f)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def lock_journal(f) -> bool:
+    """
+    Takes an exclusive lock on an open journal without waiting.  The lock is held until the file is closed, and is
+    released by the operating system when its process ends, so a locked journal belongs to a serializer still writing
+
+    :return: whether the lock was taken
+    """
+    try:
+        if os.name == "nt":
+            import msvcrt
+            # Locks a byte past the entries, which are still written through the locking handle
+            f.seek(2 ** 30)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            f.seek(0)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def recover_journals(base_dir: str) -> int:
+    """
+    Checks the samples listed in the journals left behind by DiskSerializers which did not close cleanly, and removes
+    the files of samples which were only partially written.  Journals still locked belong to serializers which are
+    writing, and are left alone
+
+    :param base_dir: The base directory of the DiskSerializer
+    :return: the number of samples removed
+    """
+    if not os.path.isdir(base_dir):
+        return 0
+
+    removed = 0
+    for e in os.listdir(base_dir):
+        if not e.startswith(JOURNAL_PREFIX):
+            continue
+        journal = os.path.join(base_dir, e)
+        try:
+            f = open(journal)
+        except FileNotFoundError:
+            continue
+        with f:
+            if not lock_journal(f):
+                continue
+            entries = [line.rstrip("\n").split("\t") for line in f if line.count("\t") == 1]
+
+        for img_filename, lbl_filename in entries:
+            if sample_complete(img_filename, lbl_filename):
+                continue
+            removed += 1
+            for path in (img_filename, lbl_filename):
+                if os.path.isfile(path):
+                    os.remove(path)
+        if os.path.isfile(journal):
+            os.remove(journal)
+
+    if removed:
+        print("Removed %d partially written samples from %s" % (removed, base_dir))
+    return removed
 
 
 class DiskSerializer(Serializer):
@@ -91,30 +284,172 @@ class DiskSerializer(Serializer):
             img_dir: str,
             img_fmt: str,
             lbl_dir: str,
-            lbl_fmt: str
+            lbl_fmt: str,
+            quality_gate=None,
+            preprocessor=None,
+            durability: str = "none",
+            sync_frames: int = 100,
+            sync_interval: float = 1.0,
+            recover: bool = True
     ):
+        """
+        :param durability: When written samples are flushed to stable storage, one of DURABILITY_POLICIES
+            none      left to the operating system, the journal still covers crashes of the application
+            frames    every sync_frames samples
+            interval  once sync_interval seconds have passed since the last flush
+            session   when the serializer is closed
+        :param recover: Whether to check for partially written samples left by a previous crash
+        """
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError("Unknown durability policy: %s" % durability)
+
+        self.base_dir = base_dir
         self.img_dir = os.path.join(base_dir, img_dir)
         self.lbl_dir = os.path.join(base_dir, lbl_dir)
         self.img_fmt = img_fmt.replace("\\", '/')
         self.lbl_fmt = lbl_fmt.replace("\\", '/')
+        self.quality_gate = quality_gate
+        self.preprocessor = preprocessor
 
-    def handle_data(self, point: Tuple[float, float], frame) -> None:
-        d = datetime.today()
+        self.durability = durability
+        self.sync_frames = sync_frames
+        self.sync_interval = sync_interval
+        self.commits = 0
+
+        if recover:
+            recover_journals(base_dir)
+
+        # Samples written since the last flush, listed in a journal so a crash can be recovered from
+        self._pending = []
+        self._last_commit = time.time()
+        if not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+        self._journal = open(os.path.join(base_dir, JOURNAL_PREFIX + "%d-%d" % (os.getpid(), id(self))), "w")
+        if not lock_journal(self._journal):
+            raise ValueError("Failed to lock the journal %s" % self._journal.name)
+
+    def write_sample(self, d: datetime, img: bytes, label: dict) -> None:
         img_filename = os.path.join(self.img_dir, get_fmt(self.img_fmt, d) + ".jpg")
         lbl_filename = os.path.join(self.lbl_dir, get_fmt(self.lbl_fmt, d) + ".json")
 
         mkdir_file(img_filename)
         mkdir_file(lbl_filename)
 
-        cv2.imwrite(img_filename, frame)
+        if self._journal is not None:
+            self._journal.write(img_filename + "\t" + lbl_filename + "\n")
+            self._journal.flush()
+
+        with open(img_filename, "wb") as f:
+            f.write(img)
         with open(lbl_filename, "w") as f:
-            json.dump(
-                {
-                    "x": point[0],
-                    "y": point[1]
-                },
-                f
-            )
+            json.dump(label, f)
+
+        if self._journal is None:
+            return
+        self._pending.append((img_filename, lbl_filename))
+        if self.durability in ("none", "frames") and len(self._pending) >= self.sync_frames:
+            self.commit()
+        elif self.durability == "interval" and time.time() - self._last_commit >= self.sync_interval:
+            self.commit()
+
+    def write_session(self, session_id: str, metadata: dict) -> None:
+        path = os.path.join(self.base_dir, "sessions", session_id + ".json")
+        mkdir_file(path)
+        with open(path, "w") as f:
+            json.dump(metadata, f, indent=4)
+
+    def commit(self, deadline: Optional[float] = None) -> bool:
+        """
+        Flushes every sample written since the last commit as a group, then clears the journal.  Under the none
+        policy only the journal is cleared
+
+        :param deadline: time.time() after which the flush is given up, leaving the journal as it is
+        :return: whether the samples were committed
+        """
+        if not self._pending:
+            return True
+        if self.durability != "none":
+            dirs = set()
+            for img_filename, lbl_filename in self._pending:
+                if deadline is not None and time.time() > deadline:
+                    return False
+                fsync_path(img_filename)
+                fsync_path(lbl_filename)
+                dirs.add(os.path.dirname(img_filename))
+                dirs.add(os.path.dirname(lbl_filename))
+            for e in dirs:
+                fsync_path(e)
+
+        self._journal.seek(0)
+        self._journal.truncate()
+        self._journal.flush()
+        if self.durability != "none":
+            os.fsync(self._journal.fileno())
+
+        self._pending = []
+        self._last_commit = time.time()
+        self.commits += 1
+        return True
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        if self._journal is None:
+            return
+        committed = self.commit(None if timeout is None else time.time() + timeout)
+        self._journal.close()
+        if committed:
+            os.remove(self._journal.name)
+        else:
+            # The journal is unlocked once closed, and checked by the next recover_journals()
+            print("Left %d samples which were not flushed within %.1fs to be recovered from %s" % (
+                len(self._pending), timeout, self._journal.name))
+        self._journal = None
+
+
+KEY_LAYOUTS = ["date", "station", "hash"]
+
+
+def default_station_id() -> str:
+    return platform.node() or "station"
+
+
+def layout_key(layout: str, directory: str, name: str, station: str, hash_len: int = 4) -> str:
+    """
+    Builds an object key for one of KEY_LAYOUTS
+        date     <directory>/<name>
+        station  <directory>/<station>/<name>
+        hash     <directory>/<hash>/<station>/<name>, the hash spreads the writes of every station evenly across
+                 16^hash_len prefixes so that no single prefix hits the S3 request rate limits
+
+    :param layout: One of KEY_LAYOUTS
+    :param directory: The image or label directory
+    :param name: The populated file naming format including the extension
+    :param station: The ID of the collection station
+    :param hash_len: The number of hex digits of the hash prefix
+    """
+    if layout == "date":
+        return directory + '/' + name
+    elif layout == "station":
+        return directory + '/' + station + '/' + name
+    elif layout == "hash":
+        h = hashlib.md5((station + '/' + name).encode("utf-8")).hexdigest()[:hash_len]
+        return directory + '/' + h + '/' + station + '/' + name
+    raise ValueError("Unknown key layout: %s" % layout)
+
+
+def split_layout_key(layout: str, directory: str, key: str) -> str:
+    """
+    Reverses layout_key, so the images and labels of a bucket can be paired
+
+    :return: the part of the key below directory without the hash prefix, ex. <station>/<name> for the hash layout
+    """
+    if not key.startswith(directory + '/'):
+        raise ValueError("%s is not inside of %s" % (key, directory))
+    name = key[len(directory) + 1:]
+    if layout == "hash":
+        name = name.split('/', 1)[-1]
+    elif layout not in KEY_LAYOUTS:
+        raise ValueError("Unknown key layout: %s" % layout)
+    return name
 
 
 class S3Serializer(Serializer):
@@ -126,8 +461,24 @@ class S3Serializer(Serializer):
             lbl_dir: str,
             lbl_fmt: str,
             aws_access_key_id: str = None,
-            aws_secret_access_key: str = None
+            aws_secret_access_key: str = None,
+            quality_gate=None,
+            preprocessor=None,
+            key_layout: str = "date",
+            station_id: str = None,
+            manifest_dir: str = "manifests",
+            manifest_part_size: int = 1000
     ):
+        """
+        :param key_layout: How object keys are built, one of KEY_LAYOUTS
+        :param station_id: The ID of this collection station, defaults to the host name
+        :param manifest_dir: Where the manifests listing the samples of each session in chronological order are
+            uploaded when the layout is not "date"
+        :param manifest_part_size: Number of samples per manifest part
+        """
+        if key_layout not in KEY_LAYOUTS:
+            raise ValueError("Unknown key layout: %s" % key_layout)
+
         self.client = boto3.client(
             service_name="s3",
             aws_access_key_id=aws_access_key_id,
@@ -139,24 +490,412 @@ class S3Serializer(Serializer):
         self.img_fmt = img_fmt.replace("\\", '/')
         self.lbl_dir = lbl_dir.replace("\\", '/')
         self.lbl_fmt = lbl_fmt.replace("\\", '/')
+        self.quality_gate = quality_gate
+        self.preprocessor = preprocessor
+
+        self.key_layout = key_layout
+        self.station_id = station_id or default_station_id()
+        self.manifest_dir = manifest_dir.replace("\\", '/')
+        self.manifest_part_size = manifest_part_size
+        self.session = datetime.today().strftime("%Y%m%d-%H%M%S") + "-%d" % os.getpid()
+        self._manifest = []
+        self._manifest_part = 0
+
+    def write_sample(self, d: datetime, img: bytes, label: dict) -> None:
+        img_filename = layout_key(self.key_layout, self.img_dir, get_fmt(self.img_fmt, d) + ".jpg", self.station_id)
+        lbl_filename = layout_key(self.key_layout, self.lbl_dir, get_fmt(self.lbl_fmt, d) + ".json", self.station_id)
+
+        self.client.upload_fileobj(io.BytesIO(img), self.bucket, img_filename)
+        self.client.upload_fileobj(io.BytesIO(json.dumps(label).encode("utf-8")), self.bucket, lbl_filename)
+
+        if self.key_layout != "date":
+            self._manifest.append({
+                "time": d.isoformat(),
+                "img": img_filename,
+                "lbl": lbl_filename
+            })
+            if len(self._manifest) >= self.manifest_part_size:
+                self.upload_manifest()
+
+    def upload_manifest(self) -> None:
+        """
+        Uploads the samples written since the last upload as the next part of the session manifest
+        """
+        if not self._manifest:
+            return
+        key = "%s/%s/%s-%05d.jsonl" % (self.manifest_dir, self.station_id, self.session, self._manifest_part)
+        body = "".join(json.dumps(e) + "\n" for e in self._manifest)
+        self.client.upload_fileobj(io.BytesIO(body.encode("utf-8")), self.bucket, key)
+        self._manifest = []
+        self._manifest_part += 1
+
+    def warm_up(self, frame) -> None:
+        super(S3Serializer, self).warm_up(frame)
+        # Opens the connection, so the first upload does not wait on the TLS handshake
+        self.client.head_bucket(Bucket=self.bucket)
+
+    def start_session(self, session_id: str) -> None:
+        # The manifest parts are named after the session, so they can be matched with its metadata
+        self.upload_manifest()
+        self.session = session_id
+        self._manifest_part = 0
+
+    def write_session(self, session_id: str, metadata: dict) -> None:
+        # Kept apart from the manifest parts, which read_manifests() lists by station
+        key = "%s/sessions/%s/%s.json" % (self.manifest_dir, self.station_id, session_id)
+        self.client.upload_fileobj(io.BytesIO(json.dumps(metadata).encode("utf-8")), self.bucket, key)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        self.upload_manifest()
+
+
+def read_manifests(client, bucket: str, manifest_dir: str = "manifests", station_id: str = None) -> List[dict]:
+    """
+    Reads the manifests uploaded by S3Serializers using a "station" or "hash" key layout
+
+    :param client: A boto3 s3 client
+    :param bucket: The bucket the samples were written to
+    :param manifest_dir: The manifest directory used by the serializers
+    :param station_id: Only reads the manifests of this station if given
+    :return: the samples of every manifest in chronological order, as dicts of "time", "img" and "lbl"
+    """
+    prefix = manifest_dir.replace("\\", '/') + '/'
+    if station_id is not None:
+        prefix += station_id + '/'
 
-    def handle_data(self, point: Tuple[float, float], frame) -> None:
-        tmp_filename = os.path.join(cache_dir, "tmp.jpg")
-        cv2.imwrite(tmp_filename, frame)
+    entries = []
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith(".jsonl"):
+                continue
+            body = client.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read().decode("utf-8")
+            entries.extend(json.loads(line) for line in body.splitlines() if line)
 
-        d = datetime.today()
-        img_filename = self.img_dir + '/' + get_fmt(self.img_fmt, d) + ".jpg"
-        lbl_filename = self.lbl_dir + '/' + get_fmt(self.lbl_fmt, d) + ".json"
+    entries.sort(key=lambda e: e["time"])
+    return entries
 
-        with open(tmp_filename, "rb") as f:
-            self.client.upload_fileobj(f, self.bucket, img_filename)
-        f = io.StringIO()
-        json.dump(
-            {
+
+class MultiSerializer(Serializer):
+    """
+    Writes every frame to several targets while encoding it only once per distinct preprocessing
+
+    Each target is written from its own thread and queue, so a slow target does not hold back the others.  When a
+    target falls behind by more than max_queue samples, its new samples are dropped.  The outcome for every target of
+    every sample is appended to a jsonl status file
+    """
+
+    def __init__(self, targets: Dict[str, Serializer], status_path: Optional[str] = None, max_queue: int = 256):
+        """
+        :param targets: The serializers to write to, by configuration name
+        :param status_path: The file the per-target status of each sample is appended to, not recorded if None
+        :param max_queue: Number of samples queued per target before new samples are dropped for that target
+        """
+        self.targets = targets
+        self.status_path = status_path
+        self.status = {name: {"ok": 0, "failed": 0, "dropped": 0, "filtered": 0, "abandoned": 0} for name in targets}
+
+        self._results = {}
+        self._results_lock = threading.Lock()
+        self._status_file = None
+        if status_path is not None:
+            mkdir_file(status_path)
+            self._status_file = open(status_path, "a")
+
+        self._queues = {}
+        self._threads = {}
+        for name, target in targets.items():
+            q = queue.Queue(max_queue)
+            th = threading.Thread(target=self.run_target, args=(name, target, q), daemon=True)
+            th.start()
+            self._queues[name] = q
+            self._threads[name] = th
+        self._sample_num = 0
+
+    def handle_data(
+            self,
+            point: Tuple[float, float],
+            frame,
+            extra: Optional[dict] = None,
+            t: Optional[float] = None
+    ) -> None:
+        d = datetime.today() if t is None else datetime.fromtimestamp(t)
+        self._sample_num += 1
+        sample = "%s-%d" % (d.isoformat(), self._sample_num)
+
+        # The quality metrics are measured once and judged against the thresholds of each target
+        metrics = None
+        encoded = {}
+        writes = {}
+        filtered = []
+        for name, target in self.targets.items():
+            label = {
                 "x": point[0],
                 "y": point[1]
+            }
+            if extra:
+                label.update(extra)
+
+            gate = target.quality_gate
+            if gate is not None:
+                if metrics is None or (gate.require_face and "face" not in metrics):
+                    metrics = gate.measure(frame)
+                if not gate.apply_metrics(metrics, label):
+                    filtered.append(name)
+                    continue
+
+            key = None if target.preprocessor is None else target.preprocessor.signature()
+            if key not in encoded:
+                processed = frame if target.preprocessor is None else target.preprocessor(frame)
+                ok, img = cv2.imencode(".jpg", processed)
+                if not ok:
+                    raise ValueError("Failed to encode frame")
+                encoded[key] = img.tobytes()
+            writes[name] = (sample, d, encoded[key], label)
+
+        with self._results_lock:
+            self._results[sample] = {name: None for name in self.targets}
+            for name in filtered:
+                self.report(sample, name, "filtered")
 
-            },
-            f
+        for name, e in writes.items():
+            try:
+                self._queues[name].put_nowait(e)
+            except queue.Full:
+                with self._results_lock:
+                    self.report(sample, name, "dropped")
+
+    def write_sample(self, d: datetime, img: bytes, label: dict) -> None:
+        for name, q in self._queues.items():
+            q.put((None, d, img, label))
+
+    def run_target(self, name: str, target: Serializer, q: queue.Queue) -> None:
+        while True:
+            e = q.get()
+            if e is None:
+                return
+            sample, d, img, label = e
+            try:
+                target.write_sample(d, img, label)
+                outcome = "ok"
+            except Exception as ex:
+                print("Failed to write sample to %s: %s" % (name, ex))
+                outcome = "failed"
+            if sample is not None:
+                with self._results_lock:
+                    self.report(sample, name, outcome)
+
+    def report(self, sample: str, name: str, outcome: str) -> None:
+        """
+        Records the outcome of a sample for one target, called with the results lock held
+        """
+        self.status[name][outcome] += 1
+        outcomes = self._results[sample]
+        outcomes[name] = outcome
+        if all(e is not None for e in outcomes.values()):
+            del self._results[sample]
+            if self._status_file is not None:
+                self._status_file.write(json.dumps({"sample": sample, "targets": outcomes}) + "\n")
+
+    def warm_up(self, frame) -> None:
+        for target in self.targets.values():
+            target.warm_up(frame)
+
+    def start_session(self, session_id: str) -> None:
+        for target in self.targets.values():
+            target.start_session(session_id)
+
+    def write_session(self, session_id: str, metadata: dict) -> None:
+        for name, target in self.targets.items():
+            try:
+                target.write_session(session_id, metadata)
+            except Exception as e:
+                print("Failed to write the session metadata to %s: %s" % (name, e))
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Waits for every target to write its queued samples.  Samples still queued after the timeout are counted as
+        abandoned, and targets still busy with a write are left open
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        last_report = time.time()
+        while any(q.qsize() for q in self._queues.values()):
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(0.05)
+            if time.time() - last_report > 1:
+                print("Writing pending samples: %s" % ", ".join(
+                    "%s %d" % (name, q.qsize()) for name, q in self._queues.items()))
+                last_report = time.time()
+
+        for name, q in self._queues.items():
+            # Only this thread adds to the queues, so after discarding what is left the sentinel always fits
+            while True:
+                try:
+                    e = q.get_nowait()
+                except queue.Empty:
+                    break
+                if e is not None and e[0] is not None:
+                    with self._results_lock:
+                        self.report(e[0], name, "abandoned")
+            q.put(None)
+
+        if deadline is not None:
+            # Idle targets still need a moment to reach the sentinel
+            deadline = max(deadline, time.time() + 0.5)
+        for name, th in self._threads.items():
+            th.join(None if deadline is None else max(deadline - time.time(), 0))
+            if th.is_alive():
+                print("%s is still writing after %.1fs, it is left open" % (name, timeout))
+                continue
+            try:
+                self.targets[name].close()
+            except Exception as e:
+                print("Failed to close %s: %s" % (name, e))
+
+        with self._results_lock:
+            if self._status_file is not None:
+                self._status_file.close()
+                self._status_file = None
+        print("Fan-out status: %s" % self.status)
+
+
+def fanout_status_path(config: dict, pid: Optional[int] = None) -> str:
+    """
+    :param config: A configuration of type Multi
+    :param pid: Suffixes the file name with a process ID, for processes writing their own status files side by side
+    :return: the path of the status file the configuration appends to
+    """
+    path = config.get("status_path", os.path.join(cache_dir, "fanout-status.jsonl"))
+    if pid is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return "%s-%d%s" % (root, pid, ext)
+
+
+def serializer_from_config(config: dict, recover: bool = True) -> Serializer:
+    """
+    Creates the serializer for an output configuration without needing its widget, ex. inside of a worker process
+
+    :param config: serialized data retrieved from a TargetOptions.get_session_config() call
+    :param recover: Whether a DiskSerializer checks for samples left partially written by a crash
+    """
+    if config["type"] == "Multi":
+        # Targets may share a base directory, so recovery runs once per directory before any of them writes
+        if recover:
+            for base_dir in sorted(set(
+                    e["base_dir"] for e in config["target_configs"].values() if e["type"] == "Disk"
+            )):
+                recover_journals(base_dir)
+        return MultiSerializer(
+            {name: serializer_from_config(e, False) for name, e in config["target_configs"].items()},
+            fanout_status_path(config)
+        )
+
+    quality_gate = QualityGate.from_config(config.get("quality", default_quality_config()))
+    preprocessor = FramePreprocessor.from_config(config.get("preprocess", default_preprocess_config()))
+
+    if config["type"] == "Disk":
+        durability = config.get("durability", default_durability_config())
+        return DiskSerializer(
+            config["base_dir"],
+            config["img_dir"],
+            config["img_fmt"],
+            config["lbl_dir"],
+            config["lbl_fmt"],
+            quality_gate,
+            preprocessor,
+            durability["policy"],
+            durability["frames"],
+            durability["interval"],
+            recover
+        )
+    elif config["type"] == "S3":
+        access_key = None
+        secret_key = None
+        if config["access_key"] != "default":
+            access_key = config["access_key"]
+        if config["secret_key"] != "default":
+            secret_key = config["secret_key"]
+        return S3Serializer(
+            config["bucket"],
+            config["img_dir"],
+            config["img_fmt"],
+            config["lbl_dir"],
+            config["lbl_fmt"],
+            access_key,
+            secret_key,
+            quality_gate,
+            preprocessor,
+            config.get("key_layout", "date"),
+            config.get("station_id") or None,
+            config.get("manifest_dir", "manifests")
         )
-        self.client.upload_fileobj(f, self.bucket, lbl_filename)
+    raise ValueError("Unknown output target: %s" % config["type"])
+
+
+def list_files(root: str, sub: str, exts: Tuple[str, ...]) -> Dict[str, str]:
+    """
+    Walks one directory of a tree written by DiskSerializer
+
+    :param root: The image or label directory
+    :param sub: The directory below root to walk, "" for the files directly inside of root only
+    :param exts: The lower case extensions of the files to list
+    :return: map from each key, the path relative to root without the extension, to the path of the file
+    """
+    files = {}
+    if sub:
+        walk = os.walk(os.path.join(root, sub))
+    else:
+        walk = [(root, [], [e.name for e in os.scandir(root) if e.is_file()])] if os.path.isdir(root) else []
+    for path, _, names in walk:
+        rel = os.path.relpath(path, root).replace("\\", '/')
+        for e in names:
+            name, ext = os.path.splitext(e)
+            if ext.lower() not in exts:
+                continue
+            files[name if rel == '.' else rel + '/' + name] = os.path.join(path, e)
+    return files
+
+
+def pair_directory(img_root: str, lbl_root: str, sub: str) -> List[Tuple[str, str, str]]:
+    """
+    Pairs the images and labels of one directory, runs inside of a worker process when the walk is parallel
+    """
+    images = list_files(img_root, sub, (".jpg", ".jpeg"))
+    labels = list_files(lbl_root, sub, (".json",))
+    return [(k, images[k], labels[k]) for k in images.keys() & labels.keys()]
+
+
+def pair_samples(
+        base_dir: str,
+        img_dir: str = "images",
+        lbl_dir: str = "labels",
+        executor: Optional[Executor] = None
+) -> Iterator[Tuple[str, str, str]]:
+    """
+    Walks a tree written by DiskSerializer and pairs each image with its label
+
+    Images and labels are paired by key, which is the path relative to img_dir/lbl_dir without the extension,
+    ex. "20201015/123055-123".  Images or labels missing their counterpart are skipped
+
+    :param base_dir: The base directory the DiskSerializer was writing to
+    :param img_dir: The image directory relative to base_dir
+    :param lbl_dir: The label directory relative to base_dir
+    :param executor: Walks every top level directory, ex. every day of a date format, as its own task when given
+    :return: iterator of (key, image path, label path) sorted by key
+    """
+    img_root = os.path.join(base_dir, img_dir)
+    lbl_root = os.path.join(base_dir, lbl_dir)
+
+    subs = [""]
+    if os.path.isdir(img_root):
+        subs += sorted(e.name for e in os.scandir(img_root) if e.is_dir())
+
+    if executor is None:
+        parts = [pair_directory(img_root, lbl_root, e) for e in subs]
+    else:
+        parts = list(executor.map(pair_directory, *zip(*[(img_root, lbl_root, e) for e in subs])))
+
+    samples = [e for part in parts for e in part]
+    samples.sort()
+    return iter(samples)
@@ -0,0 +1,174 @@
+import os
+import json
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+SHARD_VERSION = 1
+
+
+def shard_name(i: int) -> str:
+    """
+    :param i: The index of the shard
+    :return: the base file name of the shard, ex. shard-00003
+    """
+    return "shard-%05d" % i
+
+
+class ShardWriter:
+    """
+    Packs encoded images and their labels into a single data file with a json index
+
+    A shard consists of two files:
+        <name>.bin       the concatenated encoded images
+        <name>.idx.json  the index of the samples in the data file
+
+    The index is written last through a rename, so a shard is only complete once its index exists
+    """
+
+    def __init__(self, out_dir: str, name: str, preallocate: int = 0):
+        """
+        :param out_dir: The directory to write the shard to
+        :param name: The base file name of the shard
+        :param preallocate: The expected size of the data file in bytes, reserved up front where the platform allows
+            it so the appends do not fragment the file.  The file is truncated to the written size on close
+        """
+        self.data_path = os.path.join(out_dir, name + ".bin")
+        self.index_path = os.path.join(out_dir, name + ".idx.json")
+        self.samples = []
+        self.rejected = []
+        self.offset = 0
+        self._f = open(self.data_path, "wb")
+        if preallocate > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self._f.fileno(), 0, preallocate)
+            except OSError:
+                # Not every filesystem supports preallocation
+                pass
+
+    def add(self, key: str, img: bytes, label: dict) -> None:
+        """
+        Appends a sample to the shard
+
+        :param key: The key of the sample, ex. 20201015/123055-123
+        :param img: The encoded image
+        :param label: The label of the sample
+        """
+        self._f.write(img)
+        self.samples.append({
+            "key": key,
+            "offset": self.offset,
+            "size": len(img),
+            "label": label
+        })
+        self.offset += len(img)
+
+    def reject(self, key: str, reason: str) -> None:
+        """
+        Records a sample which was not packed into the shard
+        """
+        self.rejected.append({
+            "key": key,
+            "reason": reason
+        })
+
+    def close(self) -> None:
+        self._f.flush()
+        self._f.truncate(self.offset)
+        os.fsync(self._f.fileno())
+        self._f.close()
+
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    "version": SHARD_VERSION,
+                    "data": os.path.basename(self.data_path),
+                    "samples": self.samples,
+                    "rejected": self.rejected
+                },
+                f
+            )
+        os.replace(tmp_path, self.index_path)
+
+
+class ShardReader:
+    """
+    Random access to the samples of a single shard
+    """
+
+    def __init__(self, index_path: str):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index["version"] != SHARD_VERSION:
+            raise ValueError("Unsupported shard version: %s" % index["version"])
+
+        self.data_path = os.path.join(os.path.dirname(index_path), index["data"])
+        self.samples = {e["key"]: e for e in index["samples"]}
+        self._f = None
+
+    def keys(self) -> List[str]:
+        return list(self.samples)
+
+    def read(self, key: str) -> Tuple[bytes, dict]:
+        """
+        :param key: The key of the sample to read
+        :return: the encoded image and the label of the sample
+        """
+        e = self.samples[key]
+        if self._f is None:
+            self._f = open(self.data_path, "rb")
+        self._f.seek(e["offset"])
+        return self._f.read(e["size"]), e["label"]
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+
+def list_shards(shard_dir: str) -> List[str]:
+    """
+    :param shard_dir: A directory written by the compactor
+    :return: sorted paths of the completed shard indexes in the directory
+    """
+    return sorted(
+        os.path.join(shard_dir, e) for e in os.listdir(shard_dir) if e.endswith(".idx.json")
+    )
+
+
+def read_shard_index(shard_dir: str) -> Dict[str, str]:
+    """
+    :param shard_dir: A directory written by the compactor
+    :return: map from each key to the index path of the shard holding it
+    """
+    index_path = os.path.join(shard_dir, "index.json")
+    if os.path.isfile(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        return {k: os.path.join(shard_dir, v) for k, v in index["keys"].items()}
+
+    index = {}
+    for e in list_shards(shard_dir):
+        for k in ShardReader(e).samples:
+            index[k] = e
+    return index
+
+
+def iter_shard(index_path: str, keys: Optional[List[str]] = None) -> Iterator[Tuple[str, bytes, dict]]:
+    """
+    :param index_path: The index of the shard to read
+    :param keys: The keys to read, all samples are read in file order when not given
+    :return: iterator of (key, encoded image, label)
+    """
+    reader = ShardReader(index_path)
+    try:
+        if keys is None:
+            keys = sorted(reader.samples, key=lambda k: reader.samples[k]["offset"])
+        for k in keys:
+            img, label = reader.read(k)
+            yield k, img, label
+    finally:
+        reader.close()
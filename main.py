@@ -4,6 +4,7 @@ import platform
 import time
 import threading
 import random
+import multiprocessing
 
 from PyQt5 import QtGui
 from PyQt5 import QtCore
@@ -11,15 +12,20 @@ from PyQt5 import QtCore
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtWidgets import QMainWindow
 from PyQt5.QtWidgets import QDockWidget
-from PyQt5.QtWidgets import QTextEdit
 from PyQt5.QtWidgets import QWidget
 
 from PyQt5.QtGui import QKeyEvent
 from PyQt5.QtCore import Qt
 
-import cv2
-
-from Serialization import Serializer
+from CameraBroker import CameraBroker
+from CameraBroker import CameraPreview
+from GazePreview import GazePreview
+from GazePreview import GazePreviewWidget
+from LatencyCalibration import CalibrationPrompt
+from LatencyCalibration import PromptHistory
+from LatencyCalibration import load_latency_offset
+from CollectionSession import CollectionSession
+from MultiProcessCapture import MultiProcessSession
 from OutputWidget import DataOutputOptions
 
 disk_dir = ""
@@ -64,12 +70,16 @@ class EyePrompt(QWidget):
 
         self._runningPrompts = False
         self._runningPromptsLock = ResourceLock()
-        self._serializer = None
-        self._serializerLock = ResourceLock()
         self._dataThread = None
         self._dataThreadLock = ResourceLock()
         self._cycleLength = 1
         self._cycleLengthLock = ResourceLock()
+        self.broker = None
+        self.gazePreview = None
+        self.latencyOffset = 0.0
+        self.session = None
+        self.sessionTimer = None
+        self.collectionSession = None
 
         self._startTime = None
         self._prompt_loc = None
@@ -92,16 +102,6 @@ class EyePrompt(QWidget):
         with self._runningPromptsLock:
             self._runningPrompts = val
 
-    @property
-    def serializer(self) -> Serializer:
-        with self._serializerLock:
-            return self._serializer
-
-    @serializer.setter
-    def serializer(self, val: Serializer) -> None:
-        with self._serializerLock:
-            self._serializer = val
-
     @property
     def dataThread(self) -> threading.Thread:
         with self._dataThreadLock:
@@ -124,14 +124,55 @@ class EyePrompt(QWidget):
 
     def startPrompts(self):
         self._startTime = time.time()
+        if self.collectionSession is not None:
+            self.collectionSession.start()
 
         th = threading.Thread(target=self.collectData)
         th.start()
         self.dataThread = th
 
+    def startMultiProcessPrompts(self, config: dict):
+        """
+        Runs capture and encoding in separate processes, this process only draws the prompts it is sent
+        The live gaze preview is not available in this mode since frames never reach this process
+
+        :param config: The output configuration to write to, see TargetOptions.get_config()
+        """
+        self.session = MultiProcessSession(
+            config,
+            self.cycleLength,
+            self.latencyOffset,
+            on_prompt=self.on_prompt_event
+        )
+        if self.broker is not None:
+            # The capture process opens the camera itself
+            self.broker.suspend()
+        self.session.start()
+
+        self.sessionTimer = QtCore.QTimer(self)
+        # noinspection PyUnresolvedReferences
+        self.sessionTimer.timeout.connect(self.session.poll)
+        self.sessionTimer.start(5)
+
+    def on_prompt_event(self, loc: tuple):
+        self._prompt_loc = loc
+        self.runningPrompts = True
+        self.update()
+
     def endPrompts(self):
         self.runningPrompts = False
-        self.dataThread.join()
+        if self.session is not None:
+            self.sessionTimer.stop()
+            self.session.stop()
+            print("Multi-process capture: %s" % self.session.metrics())
+            self.session = None
+            if self.broker is not None:
+                self.broker.resume()
+        elif self.dataThread is not None:
+            self.dataThread.join()
+            if self.collectionSession is not None:
+                self.collectionSession.stop()
+                self.collectionSession = None
 
     def collectData(self):
         cycleNum = 1
@@ -139,9 +180,12 @@ class EyePrompt(QWidget):
             random.uniform(0, 1),
             random.uniform(0, 1)
         )
-        cap = cv2.VideoCapture(0)
+        history = PromptHistory(self.latencyOffset)
+        subscription = self.broker.subscribe()
 
         self.runningPrompts = True
+        history.add(time.time(), self._prompt_loc)
+        self.update()
         while self.runningPrompts:
             # assumption is that the time it take to run this loop is much less than self.cycleLength
             if time.time() > self._startTime + cycleNum * self.cycleLength:
@@ -150,16 +194,31 @@ class EyePrompt(QWidget):
                     random.uniform(0, 1),
                     random.uniform(0, 1)
                 )
+                history.add(time.time(), self._prompt_loc)
                 self.update()
 
-            ret, frame = cap.read()
-            if not ret:
+            e = subscription.get(timeout=0.1)
+            if e is None:
                 continue
-
-            if self.serializer is not None:
-                self.serializer.handle_data(self._prompt_loc, frame)
-
-        cap.release()
+            t, buf = e
+            try:
+                # Labels use the prompt that was on screen when the frame was exposed, not when it was read
+                point = history.at(t)
+                if point is None:
+                    continue
+
+                # Both are replaced from the GUI thread while frames are being read
+                gazePreview = self.gazePreview
+                collectionSession = self.collectionSession
+                if gazePreview is not None:
+                    gazePreview.submit(point, buf)
+                if collectionSession is not None:
+                    collectionSession.submit(point, t, buf)
+            finally:
+                buf.release()
+
+        subscription.close()
+        print("Dropped frames: %d, frame pool: %s" % (subscription.dropped, self.broker.pool.stats()))
 
     def paintEvent(self, e: QtGui.QPaintEvent) -> None:
         painter = QtGui.QPainter(self)
@@ -197,6 +256,11 @@ class MainWindow(QMainWindow):
         file = bar.addMenu("File")
         file.addAction("New")
         file.addAction("Save")
+        view = bar.addMenu("View")
+        self.gaze_preview_action = view.addAction("Live Gaze Preview")
+        self.gaze_preview_action.setCheckable(True)
+        self.multi_process_action = view.addAction("Multi-Process Capture")
+        self.multi_process_action.setCheckable(True)
 
         # Building the Data Output widget
         self.data_output = QDockWidget("Data Output", self)
@@ -204,23 +268,87 @@ class MainWindow(QMainWindow):
         self.data_output.setWidget(self.data_output_options)
         self.data_output.setFloating(False)
 
-        self.setCentralWidget(QTextEdit())
+        # The camera is opened once and kept warm, sessions and the preview subscribe to its frames
+        self.camera_broker = CameraBroker()
+        self.camera_broker.start()
+        self.camera_preview = CameraPreview(self.camera_broker)
+
+        self.setCentralWidget(self.camera_preview)
         self.addDockWidget(Qt.RightDockWidgetArea, self.data_output)
 
+        self.gaze_preview = None
+        self.gaze_preview_dock = None
+        self.calibration = None
+        self.prompter = None
+
+        self.set_connections()
+
+    # noinspection PyUnresolvedReferences
+    def set_connections(self):
+        self.gaze_preview_action.toggled.connect(self.on_gaze_preview_action)
+
     def shutdown(self):
         self.data_output_options.shutdown()
+        self.camera_preview.close_subscription()
+        self.camera_broker.stop()
+        if self.gaze_preview is not None:
+            self.gaze_preview.stop()
+
+    def on_gaze_preview_action(self, checked: bool) -> None:
+        """
+        Shows or hides the live gaze model, the model only runs while it is shown
+        """
+        if checked:
+            self.gaze_preview = GazePreview()
+            self.gaze_preview.start()
+            self.gaze_preview_dock = QDockWidget("Live Gaze Preview", self)
+            self.gaze_preview_dock.setWidget(GazePreviewWidget(self.gaze_preview))
+            self.addDockWidget(Qt.RightDockWidgetArea, self.gaze_preview_dock)
+        else:
+            if self.prompter is not None:
+                self.prompter.gazePreview = None
+            self.gaze_preview.stop()
+            self.gaze_preview = None
+            self.removeDockWidget(self.gaze_preview_dock)
+            self.gaze_preview_dock.deleteLater()
+            self.gaze_preview_dock = None
 
     def keyPressEvent(self, e: QKeyEvent) -> None:
         k = e.key()
         if k == Qt.Key_R:
             try:
+                if self.prompter is not None and self.prompter.isVisible():
+                    return
                 prompter = EyePrompt()
-                prompter.showFullScreen()
+                prompter.broker = self.camera_broker
                 prompter.cycleLength = 2
-                prompter.serializer = self.data_output_options.create_serializer()
-                prompter.startPrompts()
-            except ValueError:
-                pass
+                prompter.latencyOffset = load_latency_offset(disk_dir)
+                if self.multi_process_action.isChecked():
+                    config = self.data_output_options.get_current_config()
+                    prompter.showFullScreen()
+                    prompter.startMultiProcessPrompts(config)
+                else:
+                    # Everything the session needs is set up before the first prompt is shown
+                    session = CollectionSession(
+                        self.data_output_options.get_current_config(),
+                        self.camera_broker,
+                        prompter.latencyOffset,
+                        prompter.cycleLength
+                    )
+                    session.prepare()
+                    prompter.collectionSession = session
+                    if self.gaze_preview is not None:
+                        self.gaze_preview.reset()
+                        prompter.gazePreview = self.gaze_preview
+                    prompter.showFullScreen()
+                    prompter.startPrompts()
+                self.prompter = prompter
+            except ValueError as ex:
+                print(ex)
+        elif k == Qt.Key_C:
+            self.calibration = CalibrationPrompt(disk_dir, self.camera_broker)
+            self.calibration.showFullScreen()
+            self.calibration.start()
 
 
 def main():
@@ -257,4 +385,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()